@@ -0,0 +1,140 @@
+"""Times Renderer.paginate on its own, on records that have already been
+loaded and resolved, and prints the results as JSON like benchmarks.run.
+Needs inkex but not GTK.
+
+Each size is timed three ways:
+- stamp: render_one_template for every record, which is the part of
+  paginating that depends on the template rather than the layout
+- paginate_copies: every instance a copy of one record, so after the first
+  they're clones and placing them is most of the work
+- paginate_records: every instance a different record
+paginate_records minus stamp is roughly what laying instances out costs.
+
+Example, from the repository root:
+    python -m benchmarks.paginate --instances 10000 --repeat 3 --shared-defs
+"""
+from benchmarks.run import PhaseTimer, fastest
+from benchmarks.synthetic import TABLE_NAME, write_dataset
+from lib.inventory import load_inventory, resolve_records, split_quantities
+from lib.renderer import Renderer
+from lib.template_registry import TemplateRegistry
+from render_batch import load_tables
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import tempfile
+
+import inkex
+from inkex.base import SvgOutputMixin
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark Renderer.paginate on its own")
+    parser.add_argument('--instances', type=int, nargs='+', default=[10000],
+            help="Numbers of instances to paginate")
+    parser.add_argument('--rows', default='5')
+    parser.add_argument('--columns', default='2')
+    parser.add_argument('--bleed', default='3')
+    parser.add_argument('--nodes', type=int, default=50,
+            help="Pieces of static artwork in the synthetic template")
+    parser.add_argument('--slots', type=int, default=5,
+            help="Text fields in the synthetic template")
+    parser.add_argument('--shared-defs', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3,
+            help="Run each size this many times and keep the fastest time for each phase")
+    parser.add_argument('--output', help="Write the JSON here instead of to stdout")
+    return parser.parse_args(argv)
+
+
+def load_records(dataset, num_instances):
+    template_path, table_path, inventory_path = dataset
+    compiled_template = TemplateRegistry().load(template_path)
+    tables = load_tables(compiled_template, [f"{TABLE_NAME}={table_path}"])
+    entries = split_quantities(resolve_records(load_inventory(inventory_path), tables))
+    return compiled_template, [record for record, _ in entries][:num_instances]
+
+
+def run_once(compiled_template, records, options, args, timer):
+    label = f"paginate-{len(records)}"
+    svg = SvgOutputMixin.get_template(width=210, height=297, unit='mm').getroot()
+    renderer = Renderer(compiled_template, svg, options, shared_defs=args.shared_defs)
+    renderer.prepare(len(records))
+
+    per_page = renderer.options['rows'] * renderer.options['columns']
+    bleed_box_width, bleed_box_height = renderer.bleed_box_size()
+    layout = (renderer.options['rows'], renderer.options['columns'], renderer.options['bleed'],
+            bleed_box_width, bleed_box_height)
+
+    with timer.phase('stamp', label) as result:
+        for idx, record in enumerate(records):
+            renderer.render_one_template(idx, record)
+        result['instances'] = len(records)
+
+    copies = [[(records[0], min(per_page, len(records) - start))]
+            for start in range(0, len(records), per_page)]
+    with timer.phase('paginate_copies', label) as result:
+        result['pages'] = sum(1 for _ in renderer.paginate(copies, *layout))
+
+    distinct = [[(record, 1) for record in records[start:start + per_page]]
+            for start in range(0, len(records), per_page)]
+    with timer.phase('paginate_records', label) as result:
+        result['pages'] = sum(1 for _ in renderer.paginate(distinct, *layout))
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # Rendering logs every instance at debug level, which would swamp the
+    # timings if anything were listening
+    logging.getLogger("FourPrintars").setLevel(logging.WARNING)
+    logging.basicConfig(stream=sys.stderr)
+
+    options = {'rows': args.rows, 'columns': args.columns, 'bleed': args.bleed}
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for num_instances in args.instances:
+            dataset = write_dataset(data_dir, num_instances, args.nodes, args.slots)
+            compiled_template, records = load_records(dataset, num_instances)
+            runs = []
+            for _ in range(args.repeat):
+                timer = PhaseTimer()
+                run_once(compiled_template, records, options, args, timer)
+                runs.append(timer.phases)
+            phases = fastest(runs)
+            results.append({
+                'instances': num_instances,
+                'phases': phases,
+                'layout_seconds': phases['paginate_records']['seconds'] - phases['stamp']['seconds'],
+            })
+            print(f"{num_instances} instances: " + ", ".join(f"{name} {result['seconds']:.3f}s"
+                    for name, result in phases.items()), file=sys.stderr)
+
+    report = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'inkex': getattr(inkex, '__version__', None),
+        'settings': {
+            'nodes': args.nodes,
+            'slots': args.slots,
+            'shared_defs': args.shared_defs,
+            'repeat': args.repeat,
+            'render_options': options,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""Times each phase of the render pipeline on synthetic data and prints the
+results as JSON, so that runs from before and after a change can be compared.
+Needs inkex but not GTK.
+
+Example, from the repository root:
+    python -m benchmarks.run --records 100 1000 10000 --output before.json
+"""
+from benchmarks.synthetic import TABLE_NAME, write_dataset
+from lib.inventory import load_inventory, resolve_records, split_quantities
+from lib.renderer import Renderer
+from lib.column_store import snapshot_path
+from lib.template_registry import TemplateRegistry
+from render_batch import load_tables
+
+import argparse
+import cProfile
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import os.path
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import inkex
+import inkex.command
+from inkex.base import SvgOutputMixin
+from lxml import etree
+
+RENDER_OPTIONS = {'rows': '3', 'columns': '3', 'bleed': '3'}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the Four Printars render pipeline")
+    parser.add_argument('--records', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+            help="Numbers of records to benchmark with")
+    parser.add_argument('--nodes', type=int, default=50,
+            help="Pieces of static artwork in the synthetic template")
+    parser.add_argument('--slots', type=int, default=5,
+            help="Text fields in the synthetic template")
+    parser.add_argument('--shared-defs', action='store_true')
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--document', action='store_true',
+            help="Also time adding the pages to a document and writing it out. "
+                 "This gets slow quickly, so is off by default")
+    parser.add_argument('--inkscape', action='store_true',
+            help="With --document, also time Inkscape opening the document. Needs Inkscape")
+    parser.add_argument('--repeat', type=int, default=1,
+            help="Run each size this many times and keep the fastest time for each phase")
+    parser.add_argument('--profile', metavar='DIR',
+            help="Save a cProfile dump of every phase into DIR")
+    parser.add_argument('--tracemalloc', action='store_true',
+            help="Record each phase's peak Python memory use. Makes everything slower")
+    parser.add_argument('--output', help="Write the JSON here instead of to stdout")
+    return parser.parse_args(argv)
+
+
+class PhaseTimer:
+    def __init__(self, profile_dir=None, trace_memory=False):
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, label):
+        result = {}
+        profiler = cProfile.Profile() if self.profile_dir else None
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        if profiler:
+            profiler.enable()
+        start = time.perf_counter()
+
+        yield result
+
+        result['seconds'] = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{label}-{name}.prof"))
+        if self.trace_memory:
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_memory
+
+        self.phases[name] = result
+
+
+def run_once(dataset, args, timer):
+    template_path, table_path, inventory_path = dataset
+    label = os.path.splitext(os.path.basename(inventory_path))[0]
+
+    with timer.phase('template_load', label) as result:
+        compiled_template = TemplateRegistry().load(template_path)
+        result['nodes_per_instance'], result['bytes_per_instance'] = compiled_template.footprint()
+
+    table_args = [f"{TABLE_NAME}={table_path}"]
+    if os.path.exists(snapshot_path(table_path)):
+        os.remove(snapshot_path(table_path))
+    with timer.phase('table_load', label) as result:
+        tables = load_tables(compiled_template, table_args)
+        result['rows'] = tables[TABLE_NAME].num_rows
+    with timer.phase('table_load_snapshot', label) as result:
+        tables = load_tables(compiled_template, table_args)
+        result['rows'] = tables[TABLE_NAME].num_rows
+
+    with timer.phase('inventory_load', label) as result:
+        entries = list(split_quantities(resolve_records(load_inventory(inventory_path), tables)))
+        result['records'] = len(entries)
+
+    with timer.phase('render_instances', label) as result:
+        for idx, (record, _) in enumerate(entries):
+            compiled_template.stamp(idx, record)
+        result['instances'] = len(entries)
+
+    svg = SvgOutputMixin.get_template(width=210, height=297, unit='mm').getroot()
+    renderer = Renderer(compiled_template, svg, RENDER_OPTIONS, shared_defs=args.shared_defs,
+            compact=args.compact)
+    # Stamps every instance again, as well as laying them out on pages
+    with timer.phase('paginate', label) as result:
+        render_result = renderer.build(entries)
+        result['pages'] = len(render_result.page_groups)
+
+    with timer.phase('serialize', label) as result:
+        result['bytes'] = sum(len(etree.tostring(page_group)) for page_group in render_result.page_groups)
+
+    if args.document:
+        with timer.phase('add_to_document', label):
+            renderer.add_to_document(render_result)
+        with timer.phase('serialize_document', label) as result:
+            document = svg.tostring()
+            result['bytes'] = len(document)
+            result['ids'] = len(svg.xpath('//@id'))
+        with timer.phase('load_document', label):
+            inkex.elements.load_svg(io.BytesIO(document))
+        if args.inkscape:
+            document_path = os.path.join(os.path.dirname(inventory_path), f"{label}-document.svg")
+            with open(document_path, 'wb') as f:
+                f.write(document)
+            # Querying one object has Inkscape load and lay out the whole document
+            with timer.phase('inkscape_load', label):
+                inkex.command.inkscape(document_path, query_id='template_page_group_0', query_x=True)
+
+
+def fastest(runs):
+    """Keeps each phase's fastest run"""
+    phases = {}
+    for run in runs:
+        for name, result in run.items():
+            if name not in phases or result['seconds'] < phases[name]['seconds']:
+                phases[name] = result
+    return phases
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # Rendering logs every instance at debug level, which would swamp the
+    # timings if anything were listening
+    logging.getLogger("FourPrintars").setLevel(logging.WARNING)
+    logging.basicConfig(stream=sys.stderr)
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for num_records in args.records:
+            dataset = write_dataset(data_dir, num_records, args.nodes, args.slots)
+            runs = []
+            for _ in range(args.repeat):
+                timer = PhaseTimer(args.profile, args.tracemalloc)
+                run_once(dataset, args, timer)
+                runs.append(timer.phases)
+            phases = fastest(runs)
+            results.append({
+                'records': num_records,
+                'phases': phases,
+            })
+            print(f"{num_records} records: " + ", ".join(f"{name} {result['seconds']:.3f}s"
+                    for name, result in phases.items()), file=sys.stderr)
+
+    report = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'inkex': getattr(inkex, '__version__', None),
+        'settings': {
+            'nodes': args.nodes,
+            'slots': args.slots,
+            'shared_defs': args.shared_defs,
+            'compact': args.compact,
+            'repeat': args.repeat,
+            'tracemalloc': args.tracemalloc,
+            'render_options': RENDER_OPTIONS,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
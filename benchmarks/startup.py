@@ -0,0 +1,130 @@
+"""Times how long Four Printars takes from being started to showing its first
+dialog, which is most of what a user waits for each time they pick it from
+Inkscape's menu. Prints the results as JSON, like benchmarks.run. Needs GTK,
+and a display for the dialog to show on.
+
+Each run starts main.py as Inkscape would, with a throwaway home directory so
+the first-run message doesn't get in the way. Gtk.Dialog.run is swapped for
+one that exits as soon as the dialog has been drawn, so nothing in main.py has
+to know it's being timed, and any version of it can be compared.
+
+--baseline times another checkout too, taking turns with this one so both see
+the same machine load. A git worktree of an older commit does nicely.
+
+Example, from the repository root:
+    git worktree add /tmp/before HEAD~1
+    python -m benchmarks.startup --repeat 10 --baseline /tmp/before --output startup.json
+"""
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from inkex.base import SvgOutputMixin
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs main.py from the checkout in the current directory, stopping at the
+# first dialog it runs
+LAUNCHER = """
+import os, runpy, sys
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+
+def run_first_dialog(dialog):
+    dialog.show_all()
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+    print("First dialog shown", flush=True)
+    os._exit(0)
+
+Gtk.Dialog.run = run_first_dialog
+sys.path.insert(0, os.getcwd())
+sys.argv = ['main.py'] + sys.argv[1:]
+runpy.run_path('main.py', run_name='__main__')
+"""
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark Four Printars' time to first dialog")
+    parser.add_argument('--repeat', type=int, default=5,
+            help="Start Four Printars this many times")
+    parser.add_argument('--baseline', metavar='DIR',
+            help="Also time the checkout in DIR, to compare against")
+    parser.add_argument('--output', help="Write the JSON here instead of to stdout")
+    return parser.parse_args(argv)
+
+
+def time_to_first_dialog(repo_dir, document_path, home_dir):
+    env = dict(os.environ, HOME=home_dir)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', LAUNCHER, document_path], cwd=repo_dir,
+            env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if "First dialog shown" not in proc.stdout:
+        raise RuntimeError(f"Four Printars in {repo_dir} didn't get as far as its first dialog:\n{proc.stderr}")
+    return seconds
+
+
+def summarise(runs):
+    return {
+        'first_dialog_seconds': runs,
+        'fastest': min(runs),
+        'median': statistics.median(runs),
+    }
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    repo_dirs = {'current': REPO_DIR}
+    if args.baseline:
+        repo_dirs['baseline'] = os.path.abspath(args.baseline)
+
+    with tempfile.TemporaryDirectory() as home_dir:
+        config_dir = os.path.join(home_dir, '.config')
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, 'FourPrintars.yaml'), 'w') as f:
+            f.write(f"default_template_dir: {REPO_DIR}/examples\n")
+
+        document_path = os.path.join(home_dir, 'document.svg')
+        with open(document_path, 'wb') as f:
+            f.write(SvgOutputMixin.get_template(width=210, height=297, unit='mm').getroot().tostring())
+
+        runs = {name: [] for name in repo_dirs}
+        for _ in range(args.repeat):
+            for name, repo_dir in repo_dirs.items():
+                runs[name].append(time_to_first_dialog(repo_dir, document_path, home_dir))
+                print(f"{name}: first dialog after {runs[name][-1]:.3f}s", file=sys.stderr)
+
+    report = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': {
+            'repeat': args.repeat,
+            'baseline': repo_dirs.get('baseline'),
+        },
+        'results': summarise(runs['current']),
+    }
+    if args.baseline:
+        report['baseline_results'] = summarise(runs['baseline'])
+        report['median_saving_seconds'] = report['baseline_results']['median'] - report['results']['median']
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
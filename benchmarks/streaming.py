@@ -0,0 +1,136 @@
+"""Measures the peak memory use of render_batch.py --pages-per-file as the
+inventory grows, to check that it stays flat, and prints the results as JSON
+like benchmarks.run. Needs inkex but not GTK, and a Unix for peak RSS.
+
+Every size is rendered in a fresh process, since peak RSS only ever goes up
+over a process's life. The table stays the same size however many records
+there are, so any growth comes from rendering rather than from looking
+records up. --single-file also renders each size into one document, for
+comparison, which gets slow and big quickly.
+
+Example, from the repository root:
+    python -m benchmarks.streaming --records 1000 10000 100000 --output streaming.json
+"""
+from benchmarks.synthetic import TABLE_NAME, write_inventory, write_table, write_template
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import inkex
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory use of streamed renders")
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 10000, 100000],
+            help="Numbers of records to render")
+    parser.add_argument('--table-rows', type=int, default=1000,
+            help="Rows in the table the records are looked up in")
+    parser.add_argument('--nodes', type=int, default=50,
+            help="Pieces of static artwork in the synthetic template")
+    parser.add_argument('--slots', type=int, default=5,
+            help="Text fields in the synthetic template")
+    parser.add_argument('--rows', default='3')
+    parser.add_argument('--columns', default='3')
+    parser.add_argument('--pages-per-file', type=int, default=20)
+    parser.add_argument('--shared-defs', action='store_true')
+    parser.add_argument('--single-file', action='store_true',
+            help="Also render each size into a single document, to compare against")
+    parser.add_argument('--output', help="Write the JSON here instead of to stdout")
+    return parser.parse_args(argv)
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _render(argv):
+    # Runs in a process of its own
+    import render_batch
+
+    start = time.perf_counter()
+    status = render_batch.main(argv)
+    return status, time.perf_counter() - start, _peak_rss_bytes()
+
+
+def render_in_fresh_process(argv):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        status, seconds, peak_rss_bytes = pool.submit(_render, argv).result()
+    if status != 0:
+        raise RuntimeError(f"render_batch.py {' '.join(argv)} failed")
+    return {'seconds': seconds, 'peak_rss_bytes': peak_rss_bytes}
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        template_path = os.path.join(data_dir, 'template.svg')
+        table_path = os.path.join(data_dir, 'table.csv')
+        write_template(template_path, args.nodes, args.slots)
+        write_table(table_path, args.table_rows, args.slots)
+
+        for num_records in args.records:
+            inventory_path = os.path.join(data_dir, f"inventory-{num_records}.csv")
+            write_inventory(inventory_path, num_records, args.table_rows)
+            output_dir = os.path.join(data_dir, f"output-{num_records}")
+            os.makedirs(output_dir)
+
+            render_args = [template_path, '--table', f"{TABLE_NAME}={table_path}",
+                    '--inventory', inventory_path, '--rows', args.rows, '--columns', args.columns]
+            if args.shared_defs:
+                render_args.append('--shared-defs')
+
+            result = {'records': num_records}
+            result['streamed'] = render_in_fresh_process(render_args + [
+                    '--pages-per-file', str(args.pages_per_file),
+                    '--output', os.path.join(output_dir, 'streamed.svg')])
+            result['streamed']['files'] = len(os.listdir(output_dir))
+            if args.single_file:
+                result['single_file'] = render_in_fresh_process(render_args + [
+                        '--output', os.path.join(data_dir, 'single.svg')])
+            results.append(result)
+
+            print(f"{num_records} records: " + ", ".join(
+                    f"{mode} {result[mode]['peak_rss_bytes'] / 1024 / 1024:.0f}MB peak in {result[mode]['seconds']:.1f}s"
+                    for mode in ('streamed', 'single_file') if mode in result), file=sys.stderr)
+
+    report = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'inkex': getattr(inkex, '__version__', None),
+        'settings': {
+            'table_rows': args.table_rows,
+            'nodes': args.nodes,
+            'slots': args.slots,
+            'rows': args.rows,
+            'columns': args.columns,
+            'pages_per_file': args.pages_per_file,
+            'shared_defs': args.shared_defs,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Generates templates, tables and inventories of any size to benchmark with"""
+import csv
+import os.path
+
+TABLE_NAME = 'Item'
+
+SVG_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg"
+   xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+   xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+   width="{width}mm" height="{height}mm" viewBox="0 0 {width} {height}" version="1.1">
+  <sodipodi:namedview id="namedview1" inkscape:document-units="mm"/>
+  <g inkscape:label="Layer 1" inkscape:groupmode="layer" id="layer1">
+'''
+
+
+def column_names(num_slots):
+    return [f"Field{ii}" for ii in range(num_slots)]
+
+
+def write_template(path, num_nodes, num_slots, width=63, height=88):
+    """Writes a template with num_nodes pieces of static artwork and num_slots
+    text fields, the first of which is the key field"""
+    with open(path, 'w') as f:
+        f.write(SVG_HEADER.format(width=width, height=height))
+        for ii in range(num_nodes):
+            x = (ii * 7) % width
+            y = (ii * 11) % height
+            f.write(f'    <rect id="static{ii}" x="{x}" y="{y}" width="5" height="3" '
+                    f'style="fill:#{(ii * 2654435761) % 0xffffff:06x};stroke:#000000;stroke-width:0.2"/>\n')
+        for ii, column in enumerate(column_names(num_slots)):
+            display_type = 'key' if ii == 0 else 'displayonly'
+            y = 6 + ii * (height - 12) / max(num_slots, 1)
+            f.write(f'    <text id="text{ii}" x="4" y="{y:.2f}" style="font-size:3px;font-family:sans-serif">'
+                    f'<tspan id="tspan{ii}" x="4" y="{y:.2f}" data-fp-value="{TABLE_NAME}/{column}" '
+                    f'data-fp-type="{display_type}">{column}</tspan></text>\n')
+        f.write('  </g>\n</svg>\n')
+
+
+def write_table(path, num_rows, num_slots):
+    """Writes a table with a unique key in the first column"""
+    columns = column_names(num_slots)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row_idx in range(num_rows):
+            writer.writerow([f"KEY{row_idx:06d}", *(f"Value {row_idx} of {column}" for column in columns[1:])])
+
+
+def write_inventory(path, num_records, num_rows, quantity=1):
+    """Writes an inventory of num_records records, each picking a table row by
+    its key"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([f"{TABLE_NAME}/Field0", 'Quantity'])
+        for record_idx in range(num_records):
+            writer.writerow([f"KEY{record_idx % num_rows:06d}", quantity])
+
+
+def write_dataset(directory, num_records, num_nodes, num_slots):
+    """Writes a template, table and inventory into directory, returning their
+    paths"""
+    template_path = os.path.join(directory, f"template-{num_nodes}-{num_slots}.svg")
+    table_path = os.path.join(directory, f"table-{num_records}-{num_slots}.csv")
+    inventory_path = os.path.join(directory, f"inventory-{num_records}.csv")
+    write_template(template_path, num_nodes, num_slots)
+    write_table(table_path, num_records, num_slots)
+    write_inventory(inventory_path, num_records, num_records)
+    return template_path, table_path, inventory_path
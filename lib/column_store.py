@@ -0,0 +1,136 @@
+import logging
+import mmap
+import os
+import struct
+
+# A snapshot is a header, the table's headers, then each column as an array of
+# offsets into a block of UTF-8 text. Everything is little-endian, and each
+# offset array starts on an 8-byte boundary so it can be used in place.
+MAGIC = b'FPSNAP01'
+HEADER = struct.Struct('<8sqqII')
+LENGTH = struct.Struct('<Q')
+
+_log = logging.getLogger("FourPrintars.column_store")
+
+
+class MappedColumn:
+    """One column of a snapshot, decoded a value at a time straight out of the
+    memory map as values are asked for"""
+    def __init__(self, buffer, offsets, text_start):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._text_start = text_start
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[ii] for ii in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start = self._text_start + self._offsets[idx]
+        end = self._text_start + self._offsets[idx + 1]
+        return str(self._buffer[start:end], 'utf-8')
+
+    def __iter__(self):
+        return (self[ii] for ii in range(len(self)))
+
+
+def snapshot_path(csv_path):
+    directory, filename = os.path.split(csv_path)
+    return os.path.join(directory, f".{filename}.fpsnapshot")
+
+
+def read_snapshot(csv_path):
+    """Returns (headers, columns) from the snapshot of csv_path, or None if
+    there isn't one, it was taken from a different version of the file, or it
+    can't be read"""
+    path = snapshot_path(csv_path)
+    try:
+        source_stat = os.stat(csv_path)
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    try:
+        magic, mtime_ns, size, num_columns, num_rows = HEADER.unpack_from(buffer, 0)
+    except struct.error:
+        magic = None
+    if magic != MAGIC or mtime_ns != source_stat.st_mtime_ns or size != source_stat.st_size:
+        buffer.close()
+        return None
+
+    try:
+        headers, columns = _read_columns(buffer, num_columns, num_rows)
+    except (struct.error, TypeError, ValueError) as e:
+        # Truncated or corrupt, so it gets taken again from the CSV file. The
+        # map is closed once nothing refers to it any more
+        _log.debug(f"Not using snapshot {path}: {e}")
+        return None
+
+    _log.debug(f"Loaded snapshot {path}")
+    return headers, columns
+
+
+def _read_columns(buffer, num_columns, num_rows):
+    view = memoryview(buffer)
+    pos = HEADER.size
+    (headers_len,) = LENGTH.unpack_from(buffer, pos)
+    pos += LENGTH.size
+    headers = str(view[pos:pos + headers_len], 'utf-8').split('\0') if num_columns else []
+    pos += headers_len + _padding(headers_len)
+    if len(headers) != num_columns:
+        raise ValueError(f"{len(headers)} headers for {num_columns} columns")
+
+    columns = []
+    for _ in range(num_columns):
+        (text_len,) = LENGTH.unpack_from(buffer, pos)
+        pos += LENGTH.size
+        offsets_len = (num_rows + 1) * LENGTH.size
+        offsets = view[pos:pos + offsets_len].cast('Q')
+        pos += offsets_len
+        if len(offsets) != num_rows + 1 or offsets[-1] != text_len or pos + text_len > len(buffer):
+            raise ValueError("column runs past the end of the file")
+        columns.append(MappedColumn(view, offsets, pos))
+        pos += text_len + _padding(text_len)
+    return headers, columns
+
+
+def _padding(length):
+    return -length % 8
+
+
+def write_snapshot(csv_path, headers, columns):
+    """Saves the parsed table next to csv_path, keyed by the CSV file's
+    modification time and size. Failing to write it isn't an error - the table
+    just gets parsed again next time"""
+    path = snapshot_path(csv_path)
+    tmp_path = path + '.tmp'
+    num_rows = len(columns[0]) if columns else 0
+
+    try:
+        source_stat = os.stat(csv_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, source_stat.st_mtime_ns, source_stat.st_size,
+                    len(columns), num_rows))
+            encoded_headers = '\0'.join(headers).encode('utf-8')
+            f.write(LENGTH.pack(len(encoded_headers)))
+            f.write(encoded_headers)
+            f.write(b'\0' * _padding(len(encoded_headers)))
+
+            for column in columns:
+                encoded = [value.encode('utf-8') for value in column]
+                offsets = [0]
+                for value in encoded:
+                    offsets.append(offsets[-1] + len(value))
+                f.write(LENGTH.pack(offsets[-1]))
+                f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+                f.write(b''.join(encoded))
+                f.write(b'\0' * _padding(offsets[-1]))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _log.debug(f"Couldn't write snapshot {path}: {e}")
@@ -0,0 +1,90 @@
+import logging
+import os
+import os.path
+
+import yaml
+
+# The libyaml bindings are much faster, but aren't always built
+_Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+_log = logging.getLogger("FourPrintars.config")
+
+
+class ConfigStore:
+    """The user's YAML config, held in memory.
+
+    set() only changes the copy in memory, so any number of changes made
+    during one operation are written out together by the next flush(). Writes
+    go to a temporary file that then replaces the config, so a crash part way
+    through never leaves a truncated config behind, and are skipped entirely
+    when nothing would change.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._config = {}
+        self._saved = None
+
+    def load(self):
+        """Reads the config file. Returns False if there wasn't one yet, in
+        which case the next flush creates it"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._config = {}
+            self._saved = None
+            return False
+
+        self._config = yaml.load(data, Loader=_Loader) or {}
+        self._saved = self._dump()
+        return True
+
+    def get(self, *keys):
+        if len(keys) < 1:
+            raise RuntimeError("Attempted to get config without a valid path!")
+
+        curr_config_dict = self._config
+        for key in keys[:-1]:
+            curr_config_dict = curr_config_dict.get(key)
+            if not isinstance(curr_config_dict, dict):
+                return None
+
+        return curr_config_dict.get(keys[-1])
+
+    def set(self, *args):
+        """set('a', 'b', value) sets config['a']['b'] to value, creating any
+        dicts on the way"""
+        if len(args) < 2:
+            raise RuntimeError("Attempted to update config without a valid path!")
+        prefix_keys = args[:-2]
+        final_key = args[-2]
+        value = args[-1]
+
+        curr_config_dict = self._config
+        for key in prefix_keys:
+            if not isinstance(curr_config_dict.get(key), dict):
+                curr_config_dict[key] = {}
+            curr_config_dict = curr_config_dict[key]
+
+        curr_config_dict[final_key] = value
+
+    def flush(self):
+        """Writes any changes since the last load or flush"""
+        data = self._dump()
+        if data == self._saved:
+            return
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            _log.warning(f"Couldn't save config to {self.path}: {e}")
+            return
+        self._saved = data
+        _log.debug(f"Saved config to {self.path}")
+
+    def _dump(self):
+        return yaml.dump(self._config, Dumper=_Dumper, encoding='utf-8')
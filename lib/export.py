@@ -0,0 +1,370 @@
+"""Turns rendered pages into print-ready files without going through
+Inkscape's export dialog.
+
+Each page is written out as an SVG of its own, holding just that page's page
+groups and the document's defs, which a converter then turns into a PDF or
+PNG. Conversions run on a bounded queue of workers, so only a few pages are
+waiting at any time however many there are. A manifest in the output
+directory remembers what every file was made from, so pages that haven't
+changed since the last export are skipped.
+"""
+import concurrent.futures
+import copy
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import shutil
+import time
+
+import inkex
+import inkex.command
+from lxml import etree
+
+from lib.instrumentation import phase
+from lib.renderer import PAGE_INDEX_ATTR, page_of
+
+FORMATS = ('pdf', 'png')
+CONVERTERS = ('auto', 'inkscape', 'cairosvg')
+DEFAULT_DPI = 300
+
+MANIFEST_NAME = '.fourprintars-export.json'
+
+# Longest a cancelled export waits before noticing, while pages are converting
+CANCEL_CHECK_SECONDS = 0.1
+
+_log = logging.getLogger("FourPrintars.export")
+
+
+class ExportError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.errors = kwargs.pop('errors')
+        super().__init__(*args, **kwargs)
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportResult():
+    """What an export wrote. files are the per-page outputs in page order,
+    and page_seconds how long each one converted took"""
+    def __init__(self, files, merged_path, num_skipped, page_seconds, seconds):
+        self.files = files
+        self.merged_path = merged_path
+        self.num_skipped = num_skipped
+        self.page_seconds = page_seconds
+        self.seconds = seconds
+
+
+def find_converter(converter='auto'):
+    """Works out which converter to use. auto prefers Inkscape, which draws
+    everything exactly as it looks on screen, and falls back to cairosvg"""
+    errors = []
+    if converter in ('auto', 'inkscape'):
+        try:
+            inkex.command.which(inkex.command.INKSCAPE_EXECUTABLE_NAME)
+            return 'inkscape'
+        except inkex.command.CommandNotFound:
+            errors.append(f"Couldn't find Inkscape as '{inkex.command.INKSCAPE_EXECUTABLE_NAME}'. "
+                    "Set INKSCAPE_COMMAND to where it is")
+    if converter in ('auto', 'cairosvg'):
+        try:
+            import cairosvg  # noqa: F401
+            return 'cairosvg'
+        except ImportError:
+            errors.append("cairosvg isn't installed")
+    if converter not in CONVERTERS:
+        errors.append(f"'{converter}' isn't a converter. Use one of {', '.join(CONVERTERS)}")
+    raise ExportError("Nothing to convert pages with", errors=errors)
+
+
+def convert(converter, svg_path, output_path, file_format, dpi):
+    """Converts one standalone page. Runs in a worker, so that it only needs
+    things that can be pickled"""
+    start = time.perf_counter()
+    tmp_path = f"{output_path}.tmp.{file_format}"
+    if converter == 'inkscape':
+        args = {'export_filename': tmp_path, 'export_type': file_format, 'export_area_page': True}
+        if file_format == 'png':
+            args['export_dpi'] = dpi
+        inkex.command.inkscape(svg_path, **args)
+    else:
+        import cairosvg
+        if file_format == 'png':
+            cairosvg.svg2png(url=svg_path, write_to=tmp_path, dpi=dpi)
+        else:
+            cairosvg.svg2pdf(url=svg_path, write_to=tmp_path)
+    os.replace(tmp_path, output_path)
+    return time.perf_counter() - start
+
+
+def _describe_failure(e):
+    if isinstance(e, inkex.command.ProgramRunError) and e.returncode is not None:
+        # The whole of stderr is mostly warnings, and the error is last
+        stderr = e.stderr.decode('utf-8', 'replace') if isinstance(e.stderr, bytes) else e.stderr or ''
+        lines = stderr.strip().splitlines()
+        return f"{os.path.basename(e.program)} failed with exit code {e.returncode}" + (f": {lines[-1]}" if lines else "")
+    return str(e)
+
+
+class PageExporter():
+    def __init__(self, svg, output_dir, formats=('pdf',), converter='auto', workers=None,
+            dpi=DEFAULT_DPI):
+        """Exports the pages of svg that Renderer added into output_dir, as
+        page-0001.pdf and so on in page order. workers is how many pages are
+        converted at once, defaulting to one per core"""
+        errors = [f"Can't export to {file_format}. Use one of {', '.join(FORMATS)}"
+                for file_format in formats if file_format not in FORMATS]
+        if errors:
+            raise ExportError("Invalid export options", errors=errors)
+
+        self._svg = svg
+        self._output_dir = output_dir
+        self._formats = list(dict.fromkeys(formats))
+        self._converter = find_converter(converter)
+        self._workers = workers or os.cpu_count() or 1
+        self._dpi = dpi
+
+    def export(self, merged_path=None, progress=None, cancel_event=None):
+        """Converts every page that changed since the last export into
+        output_dir, then merges the PDFs into merged_path if one is given.
+
+        progress, if given, is called with (pages done, total pages) as each
+        page finishes. If cancel_event is set, ExportCancelled is raised once
+        the pages already being converted are done. Any pages that couldn't be
+        converted are reported together in an ExportError.
+        """
+        start = time.perf_counter()
+        os.makedirs(self._output_dir, exist_ok=True)
+        manifest = self._load_manifest()
+        new_manifest = {}
+
+        with phase('export_pages') as p:
+            pages = self._pages()
+            num_total = len(pages) * len(self._formats)
+            jobs = []
+            for page_number, (page, page_groups) in enumerate(pages, start=1):
+                for file_format in self._formats:
+                    jobs.append((page_number, page, page_groups, file_format))
+
+            try:
+                files, page_seconds, num_skipped, errors = self._run(jobs, manifest, new_manifest,
+                        progress, cancel_event, num_total)
+            except ExportCancelled:
+                # Pages converted before the cancel needn't be done again
+                self._save_manifest({**manifest, **new_manifest})
+                raise
+            p.add(pages=len(pages), files=len(page_seconds))
+
+        self._remove_stale(manifest, new_manifest)
+
+        if errors:
+            self._save_manifest(new_manifest)
+            raise ExportError("Could not export every page", errors=errors)
+
+        if merged_path is not None and 'pdf' in self._formats:
+            pdfs = [path for path in files if path.endswith('.pdf')]
+            with phase('export_merge'):
+                merged_path = self._merge(pdfs, merged_path, manifest, new_manifest)
+        else:
+            merged_path = None
+        self._save_manifest(new_manifest)
+
+        seconds = time.perf_counter() - start
+        self._report(files, page_seconds, num_skipped, seconds)
+        return ExportResult(files, merged_path, num_skipped, page_seconds, seconds)
+
+    def _pages(self):
+        """(page, page groups on it) for each page with any, in page order"""
+        pages = self._svg.namedview.get_pages()
+        groups_by_page = {}
+        for page_group in self._svg.xpath(f"//svg:g[@{PAGE_INDEX_ATTR}]"):
+            page = page_of(self._svg, page_group, pages)
+            if page is not None:
+                groups_by_page.setdefault((page.x, page.y), []).append(page_group)
+        return [(page, groups_by_page[(page.x, page.y)]) for page in pages
+                if (page.x, page.y) in groups_by_page]
+
+    def _run(self, jobs, manifest, new_manifest, progress, cancel_event, num_total):
+        # Standalone pages are written here as they're queued, and only a
+        # couple per worker are ever waiting, so an export of thousands of
+        # pages doesn't have them all on disk or in memory at once
+        if self._converter == 'inkscape':
+            # Inkscape runs in a process of its own anyway
+            executor = concurrent.futures.ThreadPoolExecutor(self._workers)
+        else:
+            # Spawned rather than forked, since forking a process that has
+            # other threads running, like the interface's, can deadlock
+            executor = concurrent.futures.ProcessPoolExecutor(self._workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        max_queued = self._workers * 2
+
+        files = []
+        page_seconds = {}
+        errors = []
+        num_skipped = 0
+        num_done = 0
+        queued = {}
+
+        def collect(futures):
+            nonlocal num_done
+            for future in futures:
+                output_path, svg_path, key = queued.pop(future)
+                try:
+                    page_seconds[output_path] = future.result()
+                    new_manifest[os.path.basename(output_path)] = key
+                    _log.debug(f"Exported {os.path.basename(output_path)} in {page_seconds[output_path]:.2f}s")
+                except Exception as e:
+                    # Converters fail in all sorts of ways, and one bad page
+                    # shouldn't stop the rest
+                    errors.append(f"{os.path.basename(output_path)}: {_describe_failure(e)}")
+                finally:
+                    os.remove(svg_path)
+                num_done += 1
+                if progress:
+                    progress(num_done, num_total)
+
+        def check_cancelled():
+            if cancel_event is not None and cancel_event.is_set():
+                raise ExportCancelled(f"Cancelled after {num_done} of {num_total} pages")
+
+        def collect_some():
+            # Gives up waiting now and then, so a cancel isn't held up by a
+            # slow page
+            finished, _ = concurrent.futures.wait(queued, timeout=CANCEL_CHECK_SECONDS,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(finished)
+
+        try:
+            for page_number, page, page_groups, file_format in jobs:
+                check_cancelled()
+
+                output_path = os.path.join(self._output_dir, f"page-{page_number:04d}.{file_format}")
+                files.append(output_path)
+                standalone = self._standalone_page(page, page_groups)
+                key = self._key(standalone, file_format)
+                if manifest.get(os.path.basename(output_path)) == key and os.path.exists(output_path):
+                    new_manifest[os.path.basename(output_path)] = key
+                    num_skipped += 1
+                    num_done += 1
+                    if progress:
+                        progress(num_done, num_total)
+                    continue
+
+                svg_path = f"{output_path}.svg"
+                with open(svg_path, 'wb') as f:
+                    f.write(standalone)
+                future = executor.submit(convert, self._converter, svg_path, output_path,
+                        file_format, self._dpi)
+                queued[future] = (output_path, svg_path, key)
+
+                while len(queued) >= max_queued:
+                    check_cancelled()
+                    collect_some()
+
+            while queued:
+                check_cancelled()
+                collect_some()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            for _, svg_path, _ in queued.values():
+                if os.path.exists(svg_path):
+                    os.remove(svg_path)
+
+        return files, page_seconds, num_skipped, errors
+
+    def _standalone_page(self, page, page_groups):
+        """An SVG document of just this page: the document's defs, and copies
+        of its page groups where they sit on it"""
+        root = etree.Element(self._svg.tag, nsmap=self._svg.nsmap)
+        unit = self._svg.unit
+        root.set('width', f"{self._svg.uutounit(page.width, unit):g}{unit}")
+        root.set('height', f"{self._svg.uutounit(page.height, unit):g}{unit}")
+        root.set('viewBox', f"{page.x:g} {page.y:g} {page.width:g} {page.height:g}")
+
+        for defs in self._svg.xpath("/svg:svg/svg:defs"):
+            root.append(copy.deepcopy(defs))
+        for page_group in page_groups:
+            page_copy = copy.deepcopy(page_group)
+            # In case it has since been moved into a layer
+            page_copy.set('transform', str(page_group.composed_transform()))
+            root.append(page_copy)
+        return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+    def _key(self, standalone, file_format):
+        key = hashlib.sha256(standalone)
+        key.update(repr((self._converter, file_format, self._dpi)).encode('utf-8'))
+        return key.hexdigest()
+
+    def _merge(self, pdfs, merged_path, manifest, new_manifest):
+        """Joins the page PDFs into one with pypdf, or poppler's pdfunite if
+        that's what there is. Returns merged_path, or None if neither is
+        available"""
+        key = hashlib.sha256("\n".join(new_manifest[os.path.basename(path)] for path in pdfs)
+                .encode('utf-8')).hexdigest()
+        new_manifest[os.path.basename(merged_path)] = key
+        if manifest.get(os.path.basename(merged_path)) == key and os.path.exists(merged_path):
+            _log.debug(f"{merged_path} is already up to date")
+            return merged_path
+
+        tmp_path = f"{merged_path}.tmp.pdf"
+        try:
+            import pypdf
+            writer = pypdf.PdfWriter()
+            for path in pdfs:
+                writer.append(path)
+            with open(tmp_path, 'wb') as f:
+                writer.write(f)
+        except ImportError:
+            if shutil.which('pdfunite') is None:
+                del new_manifest[os.path.basename(merged_path)]
+                _log.warning("Install pypdf, or poppler's pdfunite, to have the pages merged into one PDF. "
+                        f"They're each in {self._output_dir}")
+                return None
+            inkex.command.call('pdfunite', *pdfs, tmp_path)
+        os.replace(tmp_path, merged_path)
+        return merged_path
+
+    def _remove_stale(self, manifest, new_manifest):
+        """Removes pages left over from an earlier export of more pages"""
+        for name in manifest.keys() - new_manifest.keys():
+            if name.startswith('page-'):
+                try:
+                    os.remove(os.path.join(self._output_dir, name))
+                except OSError as e:
+                    _log.debug(f"Couldn't remove {name}: {e}")
+
+    def _report(self, files, page_seconds, num_skipped, seconds):
+        num_converted = len(page_seconds)
+        message = (f"Exported {len(files)} files to {self._output_dir} in {seconds:.1f}s with {self._converter}: "
+                f"{num_converted} converted, {num_skipped} unchanged since the last export")
+        if page_seconds:
+            slowest = max(page_seconds, key=page_seconds.get)
+            converting = sum(page_seconds.values())
+            message += (f". {num_converted / seconds:.1f} files/s across {self._workers} workers, "
+                    f"{converting / num_converted:.2f}s per file on average, "
+                    f"slowest {os.path.basename(slowest)} at {page_seconds[slowest]:.2f}s")
+        _log.info(message)
+
+    def _manifest_path(self):
+        return os.path.join(self._output_dir, MANIFEST_NAME)
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path()) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def _save_manifest(self, manifest):
+        tmp_path = self._manifest_path() + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self._manifest_path())
+        except OSError as e:
+            _log.debug(f"Couldn't save the export manifest: {e}")
@@ -0,0 +1,14 @@
+import inkex
+
+
+class DocumentExtension(inkex.GenerateExtension):
+    """Loads the document Inkscape passed in, hands it to on_document, and
+    writes it back out once on_document returns. Kept apart from main.py so
+    that inkex isn't imported until it's needed"""
+    def __init__(self, on_document=None):
+        super().__init__()
+        self.on_document = on_document
+
+    def effect(self):
+        if self.on_document is not None:
+            self.on_document(self.svg)
@@ -5,11 +5,15 @@ class EntryTableHandler:
     def __init__(self, entries):
         self._log = logging.getLogger("FourPrintars.entry_table_handler")
         self.entries = entries
+        self.selected_row_idx = None
 
     def on_match_selected(self, widget, model, iter_):
         selected_row = model[iter_]
         self._log.debug(f"Autolookup hit: Matched row {selected_row}")
 
+        # Completion models carry the table row index after the table's columns
+        self.selected_row_idx = selected_row[len(selected_row) - 1]
+
         for entry in self.entries:
             value = selected_row[entry.data_column_idx]
             self._log.debug(f"Autolookup setting {entry.data_column_name} to {repr(value)}")
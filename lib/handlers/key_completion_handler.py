@@ -0,0 +1,31 @@
+import logging
+
+
+class KeyCompletionHandler:
+    """Keeps a key entry's completion model filled with just the best few
+    matches for what's been typed, looked up through the table's KeyIndex"""
+    def __init__(self, table, path, model, limit=50):
+        self._log = logging.getLogger("FourPrintars.key_completion_handler")
+        self.table = table
+        self.index = table.key_index(path)
+        self.model = model
+        self.limit = limit
+
+    def on_changed(self, entry):
+        if entry.get_selection_bounds():
+            # Inline completion has just filled in the rest of a match and
+            # selected it - that's not the user typing, so keep the matches
+            return
+
+        row_idxs = self.index.query(entry.get_text(), self.limit)
+        self._log.debug(f"Autolookup for {entry.get_text()!r}: {len(row_idxs)} matches")
+
+        self.model.clear()
+        for row_idx in row_idxs:
+            self.model.append(self.table.row(row_idx) + [row_idx])
+        entry.get_completion().complete()
+
+    @staticmethod
+    def match_all(completion, key, iter_):
+        # The model only ever holds matches, so GTK has nothing to filter
+        return True
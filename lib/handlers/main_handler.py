@@ -12,8 +12,17 @@ class MainHandler:
     def add_record_click(self, *args):
         self.app.add_record_to_inventory()
 
+    def import_orders_click(self, *args):
+        self.app.import_orders()
+
     def remove_record_click(self, *args):
         self.app.remove_current_record()
 
     def render_click(self, *args):
         self.app.render()
+
+    def export_click(self, *args):
+        self.app.export_pages()
+
+    def render_stop_click(self, *args):
+        self.app.stop_render()
@@ -0,0 +1,168 @@
+"""Records where the time and memory go while rendering.
+
+Code wraps each phase of the work in `with phase("name") as p:` and reports
+what it did through p.add(...) and p.count_nodes(...). While instrumentation is
+disabled, phase() hands back a shared object that does nothing, so leaving the
+calls in costs next to nothing. Phases with the same name are added together,
+and phases may be nested, so a phase inside a loop reports its total.
+"""
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, which just goes without peak RSS
+    resource = None
+
+_log = logging.getLogger("FourPrintars.instrumentation")
+
+_enabled = False
+_lock = threading.Lock()
+_totals = {}
+_local = threading.local()
+
+
+def enable(trace_memory=False):
+    """Starts recording phases. trace_memory also records each phase's peak
+    Python memory use through tracemalloc, which slows everything down"""
+    global _enabled
+    _enabled = True
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def phase(name):
+    if not _enabled:
+        return _NULL_PHASE
+    return Phase(name)
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+        self._start = None
+        self._peak_bytes = 0
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def count_nodes(self, *elements):
+        # Counted by libxml2, rather than by walking the tree in Python
+        self.add(nodes=sum(int(element.xpath('count(descendant-or-self::*)')) for element in elements))
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack and tracemalloc.is_tracing():
+            # Resetting the peak below would lose the enclosing phase's peak so
+            # far, so hand it up first
+            parent = stack[-1]
+            parent._peak_bytes = max(parent._peak_bytes, tracemalloc.get_traced_memory()[1])
+        stack.append(self)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        stack = _local.stack
+        stack.pop()
+        if tracemalloc.is_tracing():
+            self._peak_bytes = max(self._peak_bytes, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]._peak_bytes = max(stack[-1]._peak_bytes, self._peak_bytes)
+
+        with _lock:
+            totals = _totals.setdefault(self.name, {'calls': 0, 'seconds': 0.0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            for key, value in self.counts.items():
+                totals[key] = totals.get(key, 0) + value
+            if tracemalloc.is_tracing():
+                totals['peak_bytes'] = max(totals.get('peak_bytes', 0), self._peak_bytes)
+            if resource is not None:
+                totals['peak_rss_bytes'] = _peak_rss_bytes()
+
+        return False
+
+
+class _NullPhase:
+    def add(self, **counts):
+        pass
+
+    def count_nodes(self, *elements):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everything else kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def summary():
+    """Returns what each phase recorded, in the order they first finished"""
+    with _lock:
+        return {name: dict(totals) for name, totals in _totals.items()}
+
+
+def log_summary(log=None, reset_after=True):
+    """Logs a readable line per phase at INFO, then the whole summary as one
+    JSON line at DEBUG for anything that wants to parse it"""
+    if not _enabled:
+        return
+    log = log or _log
+    phases = summary()
+    if not phases:
+        return
+
+    for name, totals in phases.items():
+        details = [f"{totals['seconds']:.3f}s"]
+        if totals['calls'] > 1:
+            details.append(f"{totals['calls']} calls")
+        for key in ('instances', 'pages', 'rows', 'nodes'):
+            if key in totals:
+                details.append(f"{totals[key]} {key}")
+        if 'peak_bytes' in totals:
+            details.append(f"peak {totals['peak_bytes'] / 1024 / 1024:.1f}MB traced")
+        if 'peak_rss_bytes' in totals:
+            details.append(f"process peak {totals['peak_rss_bytes'] / 1024 / 1024:.0f}MB")
+        log.info(f"{name}: " + ", ".join(details))
+    log.debug("metrics " + json.dumps(phases, sort_keys=True))
+
+    if reset_after:
+        reset()
@@ -0,0 +1,389 @@
+import csv
+import itertools
+import operator
+import os.path
+from collections.abc import Mapping
+
+
+class InventoryError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.errors = kwargs.pop('errors')
+        super().__init__(*args, **kwargs)
+
+
+def iter_inventory(path):
+    """Yields inventory records from a CSV or YAML file. Each record maps
+    "{Table}/{Column}" names to values, plus a Quantity. CSV files are read a
+    row at a time"""
+    if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+        import yaml
+        with open(path, 'r') as f:
+            records = yaml.safe_load(f) or []
+        for record in records:
+            yield _stringify(record)
+    else:
+        with open(path, 'r', newline='') as f:
+            for record in csv.DictReader(f):
+                yield _stringify(record)
+
+
+def load_inventory(path):
+    return list(iter_inventory(path))
+
+
+def inventory_columns(path):
+    """The fields an inventory file's records have. For CSV files this is
+    just the header row, so it's quick however big the file is"""
+    if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+        return set(itertools.chain.from_iterable(iter_inventory(path)))
+    with open(path, 'r', newline='') as f:
+        return set(next(csv.reader(f), []))
+
+
+def _stringify(record):
+    return {str(k): '' if v is None else str(v) for k, v in record.items()}
+
+
+def split_quantities(records):
+    """Yields (record, quantity) pairs, with the Quantity taken out of each
+    record"""
+    for record in records:
+        record = dict(record)
+        quantity = record.pop('Quantity')
+        yield record, int(quantity)
+
+
+# The inventory field saying which template a record is for, when a session
+# renders more than one
+TEMPLATE_FIELD = 'Template'
+
+
+def _template_of(record_idx, record, template_names, default):
+    """Returns the name a record's template is known by, taking the Template
+    field out of the record, or an error message"""
+    name = record.pop(TEMPLATE_FIELD, '') or default
+    if name is None:
+        return None, f"Record {record_idx + 1}: no {TEMPLATE_FIELD} given"
+    if name not in template_names:
+        return None, f"Record {record_idx + 1}: no template called \"{name}\""
+    return template_names[name], None
+
+
+def split_by_template(records, template_names, default=None):
+    """Sorts records into {template: [records]} by their Template field,
+    which may be any of the names in template_names. Records without one go
+    to the default template. Reports all the problems together"""
+    grouped = {name: [] for name in template_names.values()}
+    errors = []
+    for record_idx, record in enumerate(records):
+        record = dict(record)
+        name, error = _template_of(record_idx, record, template_names, default)
+        if error:
+            errors.append(error)
+        else:
+            grouped[name].append(record)
+
+    if errors:
+        raise InventoryError("Could not sort inventory by template", errors=errors)
+    return grouped
+
+
+def iter_template_records(records, template_names, template, default=None):
+    """Yields just the records for one template, lazily, stopping at the first
+    record for a template that isn't loaded"""
+    for record_idx, record in enumerate(records):
+        record = dict(record)
+        name, error = _template_of(record_idx, record, template_names, default)
+        if error:
+            raise InventoryError("Could not sort inventory by template", errors=[error])
+        if name == template:
+            yield record
+
+
+class RecordResolver:
+    """Fills in any table-backed fields missing from a record by looking up its
+    key fields in the matching table, as selecting a match in the UI would"""
+    def __init__(self, tables):
+        self._tables = tables
+        self._indexes = {}
+
+        for table in tables.values():
+            for output_field in table.output_fields:
+                if output_field.display_type != 'key' or output_field.path not in table.header_map:
+                    continue
+                index = self._indexes.setdefault(table.name, {}).setdefault(output_field.path, {})
+                for row_idx, value in enumerate(table.column(output_field.path)):
+                    # Records with an empty key aren't looked up by it
+                    if value:
+                        index.setdefault(value, row_idx)
+
+    def resolve(self, record_idx, record):
+        """Fills in the record in place, returning a list of problems"""
+        errors = []
+
+        for table in self._tables.values():
+            missing = [of.path for of in table.output_fields
+                    if f"{table.name}/{of.path}" not in record]
+            if not missing:
+                continue
+
+            if not table.header_map:
+                # Fields that aren't backed by a table are left blank, as
+                # they would be if nobody typed into them
+                for path in missing:
+                    record[f"{table.name}/{path}"] = ''
+                continue
+
+            row_idx = None
+            for path, index in self._indexes.get(table.name, {}).items():
+                value = record.get(f"{table.name}/{path}")
+                if value:
+                    row_idx = index.get(value)
+                    if row_idx is None:
+                        errors.append(f"Record {record_idx + 1}: no {table.name} has {path} \"{value}\"")
+                    break
+            else:
+                # With every key blank nothing is looked up, and the rest is
+                # left blank, as it is when nothing is picked in the UI
+                for path in missing:
+                    record[f"{table.name}/{path}"] = ''
+                continue
+
+            if row_idx is None:
+                continue
+
+            for path in missing:
+                if path in table.header_map:
+                    record[f"{table.name}/{path}"] = table.column(path)[row_idx]
+                else:
+                    errors.append(f"Record {record_idx + 1}: the {table.name} table has no {path} column")
+
+        return errors
+
+    def join(self, records):
+        """Matches a whole batch of orders to table rows at once, a table and
+        a key column at a time, for InventoryStore.add_many. Each order needs
+        a Quantity and a key for each table; every other field it gives that
+        differs from the matched row overrides it.
+
+        Returns ([(quantity, rows, overrides)], unmatched), where orders with a
+        key that matches nothing are left out and counted in unmatched, keyed
+        by (table, path, value). Anything else wrong is raised together as an
+        InventoryError.
+        """
+        errors = []
+        fields = dict.fromkeys(itertools.chain.from_iterable(records))
+
+        columns = {}
+
+        def values_of(field):
+            # Each field is pulled out of every order once, into a list
+            if field not in columns:
+                try:
+                    columns[field] = list(map(operator.itemgetter(field), records))
+                except KeyError:
+                    columns[field] = [record.get(field, '') for record in records]
+            return columns[field]
+
+        known_fields = {'Quantity'}
+        for table in self._tables.values():
+            known_fields.update(f"{table.name}/{of.path}" for of in table.output_fields)
+        for field in fields:
+            if field not in known_fields:
+                errors.append(f"The orders have a {field} column, which isn't a field of this template")
+        if 'Quantity' not in fields:
+            errors.append("The orders have no Quantity column")
+
+        try:
+            quantities = list(map(int, values_of('Quantity')))
+            if quantities and min(quantities) <= 0:
+                raise ValueError()
+        except ValueError:
+            # Only worth going through one at a time to say which are wrong
+            quantities = []
+            for record_idx, quantity_text in enumerate(values_of('Quantity')):
+                try:
+                    quantity = int(quantity_text)
+                    if quantity <= 0:
+                        raise ValueError(quantity)
+                except ValueError:
+                    errors.append(f"Record {record_idx + 1}: could not parse \"{quantity_text}\" as a quantity")
+                    quantity = None
+                quantities.append(quantity)
+
+        # Worked out a column at a time, then put together into each order's
+        # rows and overrides at the end
+        row_tables = []
+        row_columns = []
+        plain_fields = []
+        extra_overrides = {}
+        unmatched = {}
+        unmatched_idxs = set()
+
+        for table in self._tables.values():
+            table_fields = {f"{table.name}/{of.path}": of.path for of in table.output_fields}
+
+            if not table.header_map:
+                # Nothing to look up, so they're whatever the orders say
+                plain_fields.extend(table_fields)
+                continue
+
+            indexes = self._indexes.get(table.name, {})
+            key_paths = [path for path in indexes if f"{table.name}/{path}" in fields]
+            if not key_paths:
+                errors.append(f"The orders have no key column to look up {table.name} by")
+                continue
+            for path in table_fields.values():
+                if path not in table.header_map:
+                    errors.append(f"The {table.name} table has no {path} column")
+
+            # As in resolve, the first key an order gives a value for picks its
+            # row. The whole of the first key column is looked up in one go,
+            # and later ones only fill in orders that had no value before them
+            table_rows = None
+            pending = None
+            for path in key_paths:
+                values = values_of(f"{table.name}/{path}")
+                found = list(map(indexes[path].get, values))
+                if table_rows is None:
+                    table_rows = found
+                    misses = [record_idx for record_idx, row_idx in enumerate(found) if row_idx is None]
+                else:
+                    misses = []
+                    for record_idx in pending:
+                        if found[record_idx] is None:
+                            misses.append(record_idx)
+                        else:
+                            table_rows[record_idx] = found[record_idx]
+
+                pending = []
+                for record_idx in misses:
+                    value = values[record_idx]
+                    if value:
+                        key = (table.name, path, value)
+                        unmatched[key] = unmatched.get(key, 0) + 1
+                        unmatched_idxs.add(record_idx)
+                    else:
+                        pending.append(record_idx)
+            for record_idx in pending:
+                errors.append(f"Record {record_idx + 1}: no key given to look up {table.name} by")
+
+            row_tables.append(table.name)
+            row_columns.append(table_rows)
+
+            # Whatever was matched on the first key column is equal to its row
+            # already, so only the rest can override anything
+            for field, path in table_fields.items():
+                if field not in fields or path == key_paths[0] or path not in table.header_map:
+                    continue
+                column = table.column(path)
+                values = values_of(field)
+                for record_idx in [record_idx for record_idx, value in enumerate(values) if value]:
+                    row_idx = table_rows[record_idx]
+                    if row_idx is not None and column[row_idx] != values[record_idx]:
+                        extra_overrides.setdefault(record_idx, {})[field] = values[record_idx]
+
+        if errors:
+            raise InventoryError("Could not import orders", errors=errors)
+
+        # Filled a column at a time, which is quicker than zipping each
+        # order's values into a new dict
+        rows = [{} for _ in records]
+        for table_name, table_rows in zip(row_tables, row_columns):
+            for record_rows, row_idx in zip(rows, table_rows):
+                record_rows[table_name] = row_idx
+        overrides = [{} for _ in records]
+        for field in plain_fields:
+            for record_overrides, value in zip(overrides, values_of(field)):
+                record_overrides[field] = value
+        for record_idx, record_overrides in extra_overrides.items():
+            overrides[record_idx].update(record_overrides)
+
+        entries = list(zip(quantities, rows, overrides))
+        if unmatched_idxs:
+            entries = [entry for record_idx, entry in enumerate(entries)
+                    if record_idx not in unmatched_idxs]
+        return entries, unmatched
+
+    def iter_resolved(self, records):
+        """Yields resolved records lazily, stopping at the first bad one"""
+        for record_idx, record in enumerate(records):
+            if errors := self.resolve(record_idx, record):
+                raise InventoryError("Could not resolve inventory", errors=errors)
+            yield record
+
+
+def resolve_records(records, tables):
+    """Resolves every record, reporting all the problems together"""
+    resolver = RecordResolver(tables)
+    errors = []
+    for record_idx, record in enumerate(records):
+        errors += resolver.resolve(record_idx, record)
+
+    if errors:
+        raise InventoryError("Could not resolve inventory", errors=errors)
+
+    return records
+
+
+class InventoryRecord(Mapping):
+    """One line of the inventory: how many copies to print, which table row
+    each table's fields come from, and any values typed in by hand. Reads
+    through to the tables, so nothing is copied out of them"""
+    __slots__ = ('quantity', 'rows', 'overrides', '_store')
+
+    def __init__(self, store, quantity, rows, overrides):
+        self.quantity = quantity
+        self.rows = rows
+        self.overrides = overrides
+        self._store = store
+
+    def __getitem__(self, field):
+        if field in self.overrides:
+            return self.overrides[field]
+        table_name, path = field.split('/', 1)
+        if table_name not in self.rows:
+            raise KeyError(field)
+        return self._store.tables[table_name].column(path)[self.rows[table_name]]
+
+    def __iter__(self):
+        return iter(self._store.fields)
+
+    def __len__(self):
+        return len(self._store.fields)
+
+    def __repr__(self):
+        return f"InventoryRecord(quantity={self.quantity}, rows={self.rows}, overrides={self.overrides})"
+
+
+class InventoryStore:
+    """The records queued up for rendering, shared between the inventory view
+    and the renderer"""
+    def __init__(self, tables):
+        self.tables = tables
+        self.fields = [f"{table_name}/{of.path}"
+                for table_name, table in tables.items()
+                for of in table.output_fields]
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        return self.records[idx]
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, quantity, rows, overrides):
+        """Appends a record, returning its index"""
+        self.records.append(InventoryRecord(self, quantity, rows, overrides))
+        return len(self.records) - 1
+
+    def add_many(self, entries):
+        """Appends a (quantity, rows, overrides) record for each entry"""
+        self.records.extend(InventoryRecord(self, quantity, rows, overrides)
+                for quantity, rows, overrides in entries)
+
+    def remove(self, idx):
+        del self.records[idx]
@@ -0,0 +1,98 @@
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GObject, Gtk
+
+# PyGObject hands a TreeIter's user_data of 0 back as None, so iterators hold
+# the record's index plus this
+USER_DATA_OFFSET = 1
+
+
+class InventoryTreeModel(GObject.GObject, Gtk.TreeModel):
+    """A flat Gtk.TreeModel that reads straight out of an InventoryStore.
+    Column 0 is the quantity, followed by one column per inventory field.
+
+    Iterators carry the record's index, so nothing is copied into GTK. Records
+    must be added and removed through this model so the view hears about it.
+    """
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self._stamp = id(self) & 0x7fffffff
+
+    def add(self, quantity, rows, overrides):
+        idx = self.store.add(quantity, rows, overrides)
+        path = Gtk.TreePath((idx,))
+        self.row_inserted(path, self.get_iter(path))
+
+    def remove(self, path):
+        idx = path.get_indices()[0]
+        if idx < len(self.store):
+            self.store.remove(idx)
+            self.row_deleted(path)
+
+    def _iter_for(self, idx):
+        if 0 <= idx < len(self.store):
+            iter_ = Gtk.TreeIter()
+            iter_.stamp = self._stamp
+            iter_.user_data = idx + USER_DATA_OFFSET
+            return (True, iter_)
+        return (False, None)
+
+    def _idx(self, iter_):
+        return iter_.user_data - USER_DATA_OFFSET
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.store.fields) + 1
+
+    def do_get_column_type(self, column):
+        return GObject.TYPE_STRING
+
+    def do_get_iter(self, path):
+        return self._iter_for(path.get_indices()[0])
+
+    def do_get_path(self, iter_):
+        return Gtk.TreePath((self._idx(iter_),))
+
+    def do_get_value(self, iter_, column):
+        record = self.store[self._idx(iter_)]
+        if column == 0:
+            return str(record.quantity)
+        return record.get(self.store.fields[column - 1], "")
+
+    def _move(self, iter_, idx):
+        # GTK passes in the iterator to move rather than taking a new one back
+        if 0 <= idx < len(self.store):
+            iter_.user_data = idx + USER_DATA_OFFSET
+            return True
+        iter_.stamp = 0
+        return False
+
+    def do_iter_next(self, iter_):
+        return self._move(iter_, self._idx(iter_) + 1)
+
+    def do_iter_previous(self, iter_):
+        return self._move(iter_, self._idx(iter_) - 1)
+
+    def do_iter_children(self, parent):
+        if parent is None:
+            return self._iter_for(0)
+        return (False, None)
+
+    def do_iter_has_child(self, iter_):
+        return False
+
+    def do_iter_n_children(self, iter_):
+        if iter_ is None:
+            return len(self.store)
+        return 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None:
+            return self._iter_for(n)
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        return (False, None)
@@ -0,0 +1,93 @@
+class LayoutError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.errors = kwargs.pop('errors')
+        super().__init__(*args, **kwargs)
+
+
+class Shelf():
+    __slots__ = ('page', 'y', 'height', 'width')
+
+    def __init__(self, page, y, height, width):
+        self.page = page
+        self.y = y
+        self.height = height
+        self.width = width
+
+
+class PackedPage():
+    """Where everything on one page goes. placements are (item index, x, y)
+    and shelves are (x, y, width, height) of each row's bleed area, all
+    relative to the top left of the page's content, which is width by height"""
+    def __init__(self):
+        self.placements = []
+        self.shelves = []
+        self.width = 0
+        self.height = 0
+
+
+def pack_shelves(sizes, page_width, page_height, bleed):
+    """Packs items of the given (width, height) sizes onto as few pages as it
+    can, keeping bleed between items and around the edges. Returns a list of
+    PackedPage.
+
+    This is first-fit decreasing height shelf packing: items are taken tallest
+    first, and each goes on the first row, on any page, with room left for it.
+    Otherwise it starts a new row on the first page with enough height left,
+    or a new page. Items of the same height keep their order.
+    """
+    errors = []
+    for width, height in set(sizes):
+        if width + 2 * bleed > page_width or height + 2 * bleed > page_height:
+            errors.append(f"A {width:g}x{height:g} template with {bleed:g} bleed doesn't fit on a {page_width:g}x{page_height:g} page")
+    if errors:
+        raise LayoutError("Could not lay out pages", errors=errors)
+
+    if not sizes:
+        return []
+
+    order = sorted(range(len(sizes)), key=lambda item_idx: -sizes[item_idx][1])
+    min_width = min(width for width, _ in sizes)
+    min_height = min(height for _, height in sizes)
+
+    pages = []
+    # Rows and pages are dropped from these once nothing else could fit, so
+    # each item only looks through the few that are still filling up
+    open_shelves = []
+    open_pages = []
+
+    for item_idx in order:
+        width, height = sizes[item_idx]
+
+        for shelf in open_shelves:
+            if shelf.width + width + bleed <= page_width:
+                break
+        else:
+            for open_page in open_pages:
+                if open_page[1] + height + bleed <= page_height:
+                    break
+            else:
+                pages.append(PackedPage())
+                open_page = [len(pages) - 1, bleed]
+                open_pages.append(open_page)
+
+            page_idx, used_height = open_page
+            shelf = Shelf(page_idx, used_height, height, bleed)
+            open_shelves.append(shelf)
+            pages[page_idx].shelves.append(shelf)
+            open_page[1] += height + bleed
+            if open_page[1] + min_height + bleed > page_height:
+                open_pages.remove(open_page)
+
+        page = pages[shelf.page]
+        page.placements.append((item_idx, shelf.width, shelf.y))
+        shelf.width += width + bleed
+        if shelf.width + min_width + bleed > page_width:
+            open_shelves.remove(shelf)
+
+    for page in pages:
+        page.shelves = [(0, shelf.y - bleed, shelf.width, shelf.height + 2 * bleed)
+                for shelf in page.shelves]
+        page.width = max(x + width for x, _, width, _ in page.shelves)
+        page.height = max(y + height for _, y, _, height in page.shelves)
+
+    return pages
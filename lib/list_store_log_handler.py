@@ -1,10 +1,49 @@
 import logging
+import threading
+from collections import deque
+
+from gi.repository import GLib
+
 
 class ListStoreLogHandler(logging.Handler):
-    def __init__(self, list_store, *args):
+    """Shows log messages in a single-column Gtk.ListStore.
+
+    Messages are queued and written to the store in one idle callback per
+    burst, rather than one store append (and one redraw) per message, and only
+    the newest max_lines are kept. Safe to log to from any thread.
+    """
+    def __init__(self, list_store, *args, max_lines=1000):
         super().__init__(*args)
         self.__list_store = list_store
+        self.__max_lines = max_lines
+        self.__pending = deque(maxlen=max_lines)
+        self.__pending_lock = threading.Lock()
+        self.__flush_scheduled = False
 
     def emit(self, record):
         msg = self.format(record)
-        self.__list_store.append([msg])
+        with self.__pending_lock:
+            self.__pending.append(msg)
+            if self.__flush_scheduled:
+                return
+            self.__flush_scheduled = True
+        GLib.idle_add(self.__flush_pending)
+
+    def __flush_pending(self):
+        with self.__pending_lock:
+            msgs = list(self.__pending)
+            self.__pending.clear()
+            self.__flush_scheduled = False
+
+        for msg in msgs:
+            self.__list_store.append([msg])
+
+        excess = len(self.__list_store) - self.__max_lines
+        if excess > 0:
+            iter_ = self.__list_store.get_iter_first()
+            for _ in range(excess):
+                if not self.__list_store.remove(iter_):
+                    break
+
+        # Returning False stops GLib calling this again
+        return False
@@ -1,6 +1,30 @@
 import inkex
 import copy
+import hashlib
+import io
+import itertools
 import logging
+import math
+import os.path
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+
+from lib.instrumentation import phase
+from lib.layout import LayoutError, pack_shelves
+from lib.template import CompiledTemplate, TemplateError
+from lib.validation import parse_options
+
+
+# Set on every page group, so a later render into the same document can find
+# the pages it would build exactly the same again
+PAGE_INDEX_ATTR = 'data-fp-page'
+PAGE_HASH_ATTR = 'data-fp-page-hash'
+# Which template built a page group. Renders only ever update or remove page
+# groups their own template built
+PAGE_TEMPLATE_ATTR = 'data-fp-template'
+
+# Only pages Renderer added are ever removed
+PAGE_LABEL_PREFIX = "Templated page "
 
 
 class RendererError(Exception):
@@ -9,138 +33,542 @@ class RendererError(Exception):
         super().__init__(*args, **kwargs)
 
 
+class RenderCancelled(Exception):
+    pass
+
+
+class RenderResult():
+    """Page groups built by Renderer.build, not yet part of any document.
+    page_idxs numbers each page group, and replacing maps the numbers of pages
+    an earlier render left in the document to the page groups they replace"""
+    def __init__(self, page_groups, num_records, first_page_idx=0, page_idxs=None,
+            replacing=None, num_pages=None):
+        self.page_groups = page_groups
+        self.num_records = num_records
+        self.first_page_idx = first_page_idx
+        if page_idxs is None:
+            page_idxs = range(first_page_idx, first_page_idx + len(page_groups))
+        self.page_idxs = list(page_idxs)
+        self.replacing = replacing or {}
+        self.num_pages = len(page_groups) if num_pages is None else num_pages
+
+
 class Renderer():
-    def __init__(self, template, svg, options):
-        self._template = template
-        template_root = template.getroot()
-        width = template_root.get('width')
-        height = template_root.get('height')
-        self._template_width_mm = inkex.units.convert_unit(width, 'mm')
-        self._template_height_mm = inkex.units.convert_unit(height, 'mm')
+    def __init__(self, template, svg, options, shared_defs=False, processes=1,
+            incremental=False, compact=False, template_name=None):
+        """template is either an SVG document or a CompiledTemplate, which is
+        copied rather than changed. With incremental, pages the same template
+        left in the document in an earlier render are updated in place, and
+        only rebuilt if what's on them has changed. template_name is how pages
+        are known to be the same template's, and defaults to a hash of the
+        template. With compact, instances are trimmed as described in
+        CompiledTemplate.compact"""
+        if isinstance(template, CompiledTemplate):
+            self._compiled_template = template.copy()
+        else:
+            try:
+                self._compiled_template = CompiledTemplate(template)
+            except TemplateError as e:
+                raise RendererError("Invalid template", errors=e.errors)
+        self._shared_defs = shared_defs
+        self._symbol_id = None
+        self._symbol = None
+        self._blank_record = None
+        self._processes = processes
+        self._incremental = incremental
+        self._compact = compact
+        template_hash = hashlib.sha256(self._compiled_template.tostring()).hexdigest()
+        self._template_name = template_name or template_hash
+        # What compacting took out of instances to add to the document once.
+        # Named after the template, so the same template always gets the same
+        # names, and another template never does
+        self._defs = None
+        if compact:
+            self._defs_prefix = "four_printars_" + template_hash[:8]
         self._svg = svg
-        self._options = {}
+        self._raw_options = dict(options)
         self._parse_options(options)
         self._log = logging.getLogger("FourPrintars")
 
     def _parse_options(self, options):
-        errors = []
-
-        if set(options.keys()) != set(['rows', 'columns', 'bleed']):
-            raise ValueError("Options don't make sense")
-
-        try:
-            self._options['rows'] = int(options['rows'])
-            if self._options['rows'] <= 0:
-                raise ValueError(self._options['rows'])
-        except ValueError:
-            errors.append(f"Could not parse \"{options['rows']}\" as a number of rows. Please input a whole number")
-
-        try:
-            self._options['columns'] = int(options['columns'])
-            if self._options['columns'] <= 0:
-                raise ValueError(self._options['columns'])
-        except ValueError:
-            errors.append(f"Could not parse \"{options['columns']}\" as a number of columns. Please input a whole number")
-
-        try:
-            self._options['bleed'] = float(options['bleed'])
-            if self._options['bleed'] < 0:
-                raise ValueError(self._options['bleed'])
-        except ValueError:
-            errors.append(f"Could not parse \"{options['bleed']}\" as a bleed width. Please input a number (decimals are allowed)")
-
+        self._options, errors = parse_options(options)
         if errors:
             raise RendererError("Invalid options", errors=errors)
 
-    def render(self, records):
+    @property
+    def options(self):
+        """The parsed rows, columns and bleed"""
+        return self._options
+
+    @property
+    def cell_size(self):
+        """The width and height of one instance, in the template's user units"""
+        return self._compiled_template.cell_width, self._compiled_template.cell_height
+
+    @property
+    def size_mm(self):
+        """The width and height of one instance, in mm"""
+        return self._compiled_template.width_mm, self._compiled_template.height_mm
+
+    def prepare(self, num_instances, taken_ids=()):
+        """Gets the template ready for num_instances copies to be stamped,
+        sharing its static parts and compacting it if this renderer does.
+        num_instances is None when it isn't known yet, as when streaming.
+        taken_ids holds ids other renderers are about to add to the same
+        document. Returns the shared symbol's id, if there is one"""
+        if num_instances == 0:
+            # Nothing to share between
+            return self._symbol_id
+        if self._shared_defs and not (self._incremental and self._reuse_symbol()):
+            self._share_static_parts(self._unique_id("four_printars_template", taken_ids), num_instances)
+        if self._compact and self._defs is None:
+            self._compact_template()
+        return self._symbol_id
+
+    def render(self, entries):
+        """Renders (record, quantity) pairs onto new pages after the last page
+        of the document. Each record is rendered once, and further copies of it
+        are clones of that first render"""
+        self.add_to_document(self.build(entries))
+
+    def build(self, entries, progress=None, cancel_event=None, first_page_idx=0):
+        """Builds the page groups for (record, quantity) pairs without touching
+        the document, so it can run off the main thread. Returns a RenderResult
+        for add_to_document.
+
+        progress, if given, is called with (records rendered, total records)
+        after each page. If cancel_event is set, RenderCancelled is raised
+        before the next page is started. Pages are numbered from
+        first_page_idx, so that several builds can share a document.
+        """
         renders_per_page = self._options['rows'] * self._options['columns']
-        num_records_in = len(records)
-        num_pages = (len(records) + (len(records) % renders_per_page)) // renders_per_page
-        num_blanks = 0
-
-        if len(records) % renders_per_page != 0:
-            # If the number of records isn't an integer multiple of the number
-            # of records per page, create some blank ones to round up
-            num_blanks = (renders_per_page - len(records) % renders_per_page)
-            records += [{k: "" for k in records[0].keys()}] * num_blanks
-            num_pages += 1
+        with phase('record_flattening') as p:
+            num_records_in = sum(quantity for _, quantity in entries)
+            pages = list(self._iter_page_entries(entries))
+            p.add(instances=num_records_in, pages=len(pages))
+        num_pages = len(pages)
+        num_blanks = num_pages * renders_per_page - num_records_in
 
         self._log.debug(f"Rendering {num_records_in} plus {num_blanks} blanks in a {self._options['columns']}x{self._options['rows']} grid on {num_pages} pages")
 
-        last_page = self._svg.namedview.get_pages()[-1]
+        self.prepare(num_pages * renders_per_page)
+
+        with phase('page_hashing') as p:
+            page_hashes = list(self._page_hashes(pages))
+            p.add(pages=num_pages)
+
+        # Pages are built in runs of consecutive pages that need building, so
+        # a full render is a single run
+        existing = self._existing_page_groups() if self._incremental else {}
+        replacing = {}
+        runs = []
+        for offset, (page, page_hash) in enumerate(zip(pages, page_hashes)):
+            page_idx = first_page_idx + offset
+            old_page_group = existing.get(page_idx)
+            if old_page_group is not None:
+                if old_page_group.get(PAGE_HASH_ATTR) == page_hash:
+                    continue
+                replacing[page_idx] = old_page_group
+            if runs and runs[-1][0] + len(runs[-1][1]) == page_idx:
+                runs[-1][1].append(page)
+            else:
+                runs.append((page_idx, [page]))
+
+        build_pages = [page for _, run in runs for page in run]
+        page_idxs = [page_idx + ii for page_idx, run in runs for ii in range(len(run))]
+        num_records_to_build = sum(count for page in build_pages
+                for record, count in page if record is not self._blank_record)
+        if self._incremental:
+            self._log.info(f"Rebuilding {len(build_pages)} of {num_pages} pages, "
+                    f"{num_pages - len(build_pages)} are unchanged since the last render")
+
+        if self._processes > 1:
+            page_iter = self._paginate_in_pool(runs)
+        else:
+            page_iter = self._paginate_runs(runs)
+
+        page_groups = []
+        num_records_done = 0
+        with phase('pagination') as p:
+            try:
+                for page, page_idx, page_group in zip(build_pages, page_idxs, page_iter):
+                    page_group.set(PAGE_INDEX_ATTR, str(page_idx))
+                    page_group.set(PAGE_HASH_ATTR, page_hashes[page_idx - first_page_idx])
+                    page_group.set(PAGE_TEMPLATE_ATTR, self._template_name)
+                    page_groups.append(page_group)
+                    num_records_done += sum(count for record, count in page if record is not self._blank_record)
+                    if progress:
+                        progress(num_records_done, num_records_to_build)
+                    if cancel_event is not None and cancel_event.is_set() and len(page_groups) < len(build_pages):
+                        raise RenderCancelled(f"Cancelled after {len(page_groups)} of {len(build_pages)} pages")
+            finally:
+                page_iter.close()
+            p.add(pages=len(page_groups), instances=len(page_groups) * renders_per_page)
+            p.count_nodes(*page_groups)
+
+        return RenderResult(page_groups, num_records_in, first_page_idx, page_idxs, replacing, num_pages)
+
+    def add_to_document(self, result):
+        """Adds a finished build to the document: the new pages, the shared
+        symbol if there is one, and a page group on each page. Rebuilt pages
+        replace the page groups an earlier render left on them"""
+        with phase('page_creation') as p:
+            added = [(page_idx, page_group) for page_idx, page_group
+                    in zip(result.page_idxs, result.page_groups) if page_idx not in result.replacing]
+            new_pages = self.add_pages(self._svg, [page_idx for page_idx, _ in added])
+            self.add_defs(self._svg)
+
+            for page, (_, page_group) in zip(new_pages, added):
+                self._place_page_group(self._svg, page, page_group)
+
+            for page_idx, page_group in zip(result.page_idxs, result.page_groups):
+                if page_idx in result.replacing:
+                    old_page_group = result.replacing[page_idx]
+                    page = page_of(self._svg, old_page_group)
+                    old_page_group.getparent().remove(old_page_group)
+                    self._place_page_group(self._svg, page, page_group)
+            p.add(pages=len(new_pages))
+
+        self._log.info(f"Successfully rendered {result.num_records} records on {result.num_pages} pages")
+
+    def remove_pages_outside(self, first_page_idx, end_page_idx):
+        """Removes the page groups an earlier render of the same template left
+        numbered outside first_page_idx up to end_page_idx, along with their
+        pages, for when a render into the same document needs fewer pages than
+        last time, or numbers them differently"""
+        num_removed = 0
+        for existing_idx, page_group in self._existing_page_groups().items():
+            if first_page_idx <= existing_idx < end_page_idx:
+                continue
+            page = page_of(self._svg, page_group)
+            if page is not None and (page.get('inkscape:label') or '').startswith(PAGE_LABEL_PREFIX):
+                page.getparent().remove(page)
+            page_group.getparent().remove(page_group)
+            num_removed += 1
+        if num_removed:
+            self._log.info(f"Removed {num_removed} pages left over from the last render")
+
+    def render_to_files(self, entries, output_path, pages_per_file):
+        """Renders (record, quantity) pairs into a series of documents, each a
+        copy of this renderer's document with at most pages_per_file new pages,
+        written next to output_path with a numbered suffix.
+
+        Entries are consumed lazily and each document is built, written and
+        dropped before the next one starts, so memory use depends on
+        pages_per_file rather than on the number of records. Returns the paths
+        written.
+        """
+        renders_per_page = self._options['rows'] * self._options['columns']
+        base_document = etree.tostring(self._svg)
+        output_stem, output_ext = os.path.splitext(output_path)
+
+        self.prepare(None)
+
+        bleed_box_width, bleed_box_height = self.bleed_box_size()
+        page_entries = self._iter_page_entries(entries)
+        output_paths = []
+        num_records_in = 0
+        num_pages = 0
+
+        while file_pages := list(itertools.islice(page_entries, pages_per_file)):
+            svg = inkex.elements.load_svg(io.BytesIO(base_document)).getroot()
+            self.add_defs(svg, copy_defs=True)
+
+            with phase('pagination') as p:
+                new_pages = self.add_pages(svg, range(num_pages, num_pages + len(file_pages)))
+                page_iter = self.paginate(
+                                file_pages,
+                                self._options['rows'],
+                                self._options['columns'],
+                                self._options['bleed'],
+                                bleed_box_width,
+                                bleed_box_height,
+                                first_page_idx=num_pages,
+                            )
+                for page, page_group in zip(new_pages, page_iter):
+                    self._place_page_group(svg, page, page_group)
+                    p.count_nodes(page_group)
+                p.add(pages=len(file_pages), instances=len(file_pages) * renders_per_page)
+
+            file_path = f"{output_stem}-{len(output_paths) + 1:04d}{output_ext}"
+            with phase('serialization'):
+                with open(file_path, 'wb') as f:
+                    f.write(svg.tostring())
+            output_paths.append(file_path)
+
+            num_records_in += sum(quantity for page in file_pages
+                    for record, quantity in page if record is not self._blank_record)
+            num_pages += len(file_pages)
+            self._log.debug(f"Wrote pages {num_pages - len(file_pages)} to {num_pages - 1} to {file_path}")
+
+        self._log.info(f"Successfully rendered {num_records_in} records on {num_pages} pages across {len(output_paths)} files")
+        return output_paths
+
+    def _iter_page_entries(self, entries):
+        """Splits (record, quantity) pairs into each page's share of them, so
+        copies are only expanded into placements once a page is built. The last
+        page is padded out with blanks"""
+        renders_per_page = self._options['rows'] * self._options['columns']
+        page = []
+        page_count = 0
+        record = None
+
+        for record, quantity in entries:
+            while quantity > 0:
+                count = min(quantity, renders_per_page - page_count)
+                page.append((record, count))
+                page_count += count
+                quantity -= count
+                if page_count == renders_per_page:
+                    yield page
+                    page = []
+                    page_count = 0
+
+        if page:
+            # If the number of records isn't an integer multiple of the number
+            # of records per page, create some blank ones to round up
+            self._blank_record = {k: "" for k in record.keys()}
+            page.append((self._blank_record, renders_per_page - page_count))
+            yield page
+
+    def add_pages(self, svg, page_idxs):
+        """Adds a page for each of page_idxs after the last page of svg,
+        the same size as it, returning them"""
+        last_page = svg.namedview.get_pages()[-1]
         space_between_pages = 10
 
         x = last_page.x + last_page.width + space_between_pages
 
         new_pages = []
-        for ii in range(num_pages):
-            new_page = self._svg.namedview.new_page(x=str(x), y=str(last_page.y),
+        for ii in page_idxs:
+            new_page = svg.namedview.new_page(x=str(x), y=str(last_page.y),
                     width=str(last_page.width), height=str(last_page.height),
-                    label=f"Templated page {ii}")
+                    label=f"{PAGE_LABEL_PREFIX}{ii}")
             new_pages.append(new_page)
             x += last_page.width + space_between_pages
 
-        rendered_templates = [self.render_one_template(ii, record)
-                for ii, record in enumerate(records)]
-
+        return new_pages
+
+    def _place_page_group(self, svg, page, page_group):
+        bleed_box_width, bleed_box_height = self.bleed_box_size()
+        x_offs = (page.width - bleed_box_width) / 2
+        y_offs = (page.height - bleed_box_height) / 2
+        transform = inkex.transforms.Transform()
+        transform.add_translate(page.x + x_offs, page.y + y_offs)
+        page_group.set("transform", transform)
+        svg.add(page_group)
+
+    def _existing_page_groups(self):
+        """Page groups this renderer's template already built in the document,
+        by page number. If an earlier render left more than one with the same
+        number, the last one wins"""
+        return {int(page_group.get(PAGE_INDEX_ATTR)): page_group
+                for page_group in self._svg.xpath(f"//svg:g[@{PAGE_HASH_ATTR}][@{PAGE_INDEX_ATTR}]")
+                if page_group.get(PAGE_TEMPLATE_ATTR) == self._template_name}
+
+    def _page_hashes(self, pages):
+        """A hash of everything that goes into each page: the compiled
+        template, the layout, and each record's values and count"""
+        template_hash = hashlib.sha256(self._compiled_template.tostring())
+        template_hash.update(repr((self._options['rows'], self._options['columns'],
+                self._options['bleed'], self.bleed_box_size())).encode('utf-8'))
+        slot_names = self._compiled_template.slot_names
+
+        for page in pages:
+            page_hash = template_hash.copy()
+            for record, count in page:
+                page_hash.update(count.to_bytes(8, 'little'))
+                for name in slot_names:
+                    encoded = record[name].encode('utf-8')
+                    page_hash.update(len(encoded).to_bytes(8, 'little'))
+                    page_hash.update(encoded)
+            yield page_hash.hexdigest()
+
+    def _reuse_symbol(self):
+        """Shares static parts through a symbol an earlier render left in the
+        document, if one matches exactly, so the pages stamped against it are
+        still unchanged. Returns whether one did"""
+        for symbol in self._svg.xpath("//svg:defs/svg:symbol[starts-with(@id, 'four_printars_template')]"):
+            trial = self._compiled_template.copy()
+            trial_symbol = trial.share_static_parts(symbol.get("id"))
+            trial_defs = trial.compact(self._defs_prefix, trial_symbol) if self._compact else None
+            if _same_tree(trial_symbol, symbol):
+                self._compiled_template = trial
+                self._defs = trial_defs
+                self._symbol_id = symbol.get("id")
+                self._log.info(f"Reusing <symbol id=\"{self._symbol_id}\"> from the last render")
+                return True
+        return False
+
+    def _unique_id(self, prefix, taken=()):
+        # Unlike svg.get_unique_id, this is deterministic, so that re-running
+        # the same render produces the same document. taken holds ids that
+        # aren't in the document yet but will be
+        new_id = prefix
+        suffix = 1
+        while self._svg.getElementById(new_id) is not None or new_id in taken:
+            new_id = f"{prefix}_{suffix}"
+            suffix += 1
+        return new_id
+
+    def bleed_box_size(self):
+        """The width and height of a page's grid, bleed and all, in mm"""
         rows = self._options['rows']
         columns = self._options['columns']
         bleed = self._options['bleed']
-        bleed_box_width = (self._template_width_mm + bleed) * columns + bleed
-        bleed_box_height = (self._template_height_mm + bleed) * rows + bleed
-        page_iter = self.paginate(
-                        rendered_templates,
-                        rows,
-                        columns,
-                        bleed,
-                        bleed_box_width,
-                        bleed_box_height,
-                    )
-
-        for page, page_group in zip(new_pages, page_iter):
-            x_offs = (page.width - bleed_box_width) / 2
-            y_offs = (page.height - bleed_box_height) / 2
-            transform = inkex.transforms.Transform()
-            transform.add_translate(page.x + x_offs, page.y + y_offs)
-            page_group.set("transform", transform)
-
-        self._log.info(f"Successfully rendered {num_records_in} records on {num_pages} pages")
-
-    def paginate(self, renders, rows, columns, bleed, bleed_box_width,
-            bleed_box_height):
+        bleed_box_width = (self._compiled_template.width_mm + bleed) * columns + bleed
+        bleed_box_height = (self._compiled_template.height_mm + bleed) * rows + bleed
+        return bleed_box_width, bleed_box_height
+
+    def _share_static_parts(self, symbol_id, num_instances):
+        full_nodes, full_bytes = self._compiled_template.footprint()
+        symbol = self._compiled_template.share_static_parts(symbol_id)
+        self._symbol_id = symbol_id
+        self._symbol = symbol
+        instance_nodes, instance_bytes = self._compiled_template.footprint()
+        symbol_nodes = sum(1 for _ in symbol.iter())
+        symbol_bytes = len(symbol.tostring())
+
+        if not num_instances:
+            # Streaming renders don't know how many instances are coming, and
+            # there's nothing to compare against without any
+            self._log.info(f"Sharing static template parts as <symbol id=\"{symbol_id}\">: "
+                    f"{instance_nodes} nodes per instance instead of {full_nodes}, "
+                    f"~{instance_bytes / 1024:.1f}KB instead of ~{full_bytes / 1024:.1f}KB, "
+                    f"plus {symbol_nodes} nodes (~{symbol_bytes / 1024:.1f}KB) once per document")
+            return
+
+        deep_copy_nodes = full_nodes * num_instances
+        shared_nodes = symbol_nodes + instance_nodes * num_instances
+        deep_copy_kb = full_bytes * num_instances / 1024
+        shared_kb = (symbol_bytes + instance_bytes * num_instances) / 1024
+        self._log.info(f"Sharing static template parts as <symbol id=\"{symbol_id}\">: "
+                f"{shared_nodes} nodes instead of {deep_copy_nodes} "
+                f"({100 * (1 - shared_nodes / deep_copy_nodes):.0f}% fewer), "
+                f"~{shared_kb:.0f}KB instead of ~{deep_copy_kb:.0f}KB of template markup "
+                f"({100 * (1 - shared_kb / deep_copy_kb):.0f}% smaller)")
+
+    def _compact_template(self):
+        full_bytes = len(self._compiled_template.tostring())
+        self._defs = self._compiled_template.compact(self._defs_prefix, self._symbol)
+        instance_bytes = len(self._compiled_template.tostring())
+        message = f"Compacted template instances to ~{instance_bytes / 1024:.1f}KB from ~{full_bytes / 1024:.1f}KB"
+        if self._defs:
+            message += f", sharing {len(self._defs)} defs and stylesheets between them"
+        self._log.info(message)
+
+    def add_defs(self, svg, copy_defs=False):
+        """Adds the shared symbol, and anything compacting took out of
+        instances, to svg's defs. Defs and stylesheets an earlier render
+        already added are the same, so aren't added again"""
+        if self._symbol is not None:
+            svg.defs.append(copy.deepcopy(self._symbol) if copy_defs else self._symbol)
+
+        existing_styles = None
+        for element in self._defs or ():
+            if (element_id := element.get("id")) is not None:
+                if svg.getElementById(element_id) is not None:
+                    continue
+            else:
+                if existing_styles is None:
+                    existing_styles = {style.text for style in svg.xpath("//svg:style")}
+                if element.text in existing_styles:
+                    continue
+            svg.defs.append(copy.deepcopy(element) if copy_defs else element)
+
+    @property
+    def incremental(self):
+        return self._incremental
+
+    def _paginate_in_pool(self, runs):
+        """Renders page groups across worker processes, each handed the
+        serialized template and a slice of pages, and yields them back in
+        page order exactly as paginate would. runs are (first page number,
+        pages) for each run of consecutive pages"""
+        pages = [page for _, run in runs for page in run]
+        pages_per_chunk = max(1, math.ceil(len(pages) / (self._processes * 4)))
+
+        # Records may read through to tables that can't be pickled, so workers
+        # get plain dicts, converted once per distinct record
+        as_dicts = {}
+        picklable_pages = []
+        with phase('record_flattening'):
+            for page in pages:
+                picklable_page = []
+                for record, count in page:
+                    if id(record) not in as_dicts:
+                        as_dicts[id(record)] = (record, dict(record))
+                    picklable_page.append((as_dicts[id(record)][1], count))
+                picklable_pages.append(picklable_page)
+
+        # A chunk never spans two runs, since its pages are numbered on from
+        # its first
+        page_chunks = []
+        first_page_idxs = []
+        run_start = 0
+        for first_page_idx, run in runs:
+            for idx in range(0, len(run), pages_per_chunk):
+                chunk_end = min(idx + pages_per_chunk, len(run))
+                page_chunks.append(picklable_pages[run_start + idx:run_start + chunk_end])
+                first_page_idxs.append(first_page_idx + idx)
+            run_start += len(run)
+        # Sent after any static parts have been shared, so workers stamp
+        # exactly what this process would
+        initargs = (self._compiled_template.to_bytes(), self._raw_options)
+
+        executor = ProcessPoolExecutor(max_workers=self._processes,
+                initializer=_init_page_worker, initargs=initargs)
+        try:
+            for page_groups in executor.map(_render_page_chunk, first_page_idxs, page_chunks):
+                for page_group in page_groups:
+                    yield _parse_fragment(page_group)
+        finally:
+            # If the caller stops early, don't wait for chunks nobody wants
+            executor.shutdown(cancel_futures=True)
+
+    def _paginate_runs(self, runs):
+        bleed_box_width, bleed_box_height = self.bleed_box_size()
+        for first_page_idx, pages in runs:
+            yield from self.paginate(
+                            pages,
+                            self._options['rows'],
+                            self._options['columns'],
+                            self._options['bleed'],
+                            bleed_box_width,
+                            bleed_box_height,
+                            first_page_idx=first_page_idx,
+                        )
+
+    def paginate(self, pages, rows, columns, bleed, bleed_box_width,
+            bleed_box_height, first_page_idx=0):
+        """Builds a detached page group for each page's (record, count) pairs"""
         renders_per_page = rows * columns
-
-        for idx, start_pos in enumerate(range(0, len(renders), renders_per_page)):
-            page_renders = renders[start_pos:start_pos + renders_per_page]
-
-            x_coord = bleed
-            y_coord = bleed
-            x_idx = 0
-            y_idx = 0
-            max_row_height = 0
+        cell_transforms = self._cell_transforms(rows, columns, bleed)
+        last_record = None
+        last_render = None
+
+        for page_offset, page in enumerate(pages):
+            idx = first_page_idx + page_offset
+            render_idx = idx * renders_per_page
+            page_renders = []
+            for record, count in page:
+                for _ in range(count):
+                    if record is last_record:
+                        render = self.clone(last_render, render_idx)
+                    else:
+                        render = self.render_one_template(render_idx, record)
+                        last_record = record
+                        last_render = render
+                    page_renders.append(render)
+                    render_idx += 1
 
             page_group = inkex.Group.new(f"Template Page Group {idx}", id=f"template_page_group_{idx}")
-            self._svg.add(page_group)
             # page_group.set("inkscape:groupmode", "layer")
 
-            for render in page_renders:
-                transform = inkex.transforms.Transform()
-                transform.add_translate(x_coord, y_coord)
-                render.set("transform", transform)
+            for render, cell_transform in zip(page_renders, cell_transforms):
+                render.set("transform", cell_transform)
                 page_group.append(render)
 
-                bbox = self._template.getroot().get_page_bbox()
-                x_coord += bbox.width + bleed
-                if bbox.height > max_row_height:
-                    max_row_height = bbox.height
-                x_idx += 1
-                if x_idx >= columns:
-                    x_idx = 0
-                    x_coord = bleed
-                    y_idx += 1
-                    y_coord += max_row_height + bleed
-                    max_row_height = 0
-
             bleed_box = inkex.elements.Rectangle.new(0, 0, bleed_box_width, bleed_box_height)
             bleed_box.style['fill'] = 'black'
             bleed_box.style['opacity'] = 1
@@ -149,22 +577,252 @@ class Renderer():
 
             yield page_group
 
-    def render_one_template(self, idx, record):
-        new_g = inkex.Group.new(f"Template Instance {idx}", id=f"template_instance_{idx}")
-        # new_g.set("inkscape:groupmode", "layer")
+    def _cell_transforms(self, rows, columns, bleed):
+        """The transform for each slot on a page, in the order slots are
+        filled. Every page shares the same grid, so it's worked out once"""
+        cell_width = self._compiled_template.cell_width
+        cell_height = self._compiled_template.cell_height
+        cell_transforms = []
+        for y_idx in range(rows):
+            for x_idx in range(columns):
+                transform = inkex.transforms.Transform()
+                transform.add_translate(bleed + x_idx * (cell_width + bleed),
+                        bleed + y_idx * (cell_height + bleed))
+                cell_transforms.append(str(transform))
+        return cell_transforms
 
+    def render_one_template(self, idx, record):
         self._log.debug(f"Render {idx}: {record}")
+        with phase('instance_rendering') as p:
+            p.add(instances=1)
+            return self._compiled_template.stamp(idx, record)
+
+    def clone(self, render, idx):
+        """Another copy of an instance render_one_template made, numbered idx"""
+        return self._compiled_template.clone(render, idx)
+
+
+def page_of(svg, page_group, pages=None):
+    """The page a page group was centred on, found from the middle of its
+    first bleed box. pages saves finding the document's pages again when
+    looking up many page groups"""
+    transform = inkex.transforms.Transform(page_group.get("transform"))
+    bleed_box = page_group[0]
+    centre_x = transform.e + float(bleed_box.get("x", 0)) + float(bleed_box.get("width")) / 2
+    centre_y = transform.f + float(bleed_box.get("y", 0)) + float(bleed_box.get("height")) / 2
+    if pages is None:
+        pages = svg.namedview.get_pages()
+    return min(pages, default=None,
+            key=lambda page: abs(page.x + page.width / 2 - centre_x) + abs(page.y + page.height / 2 - centre_y))
+
+
+def _same_tree(a, b):
+    """Compares two elements and everything under them, ignoring where
+    namespaces happen to be declared, which differs once a document has been
+    saved and loaded again"""
+    if (a.tag, a.text or '', a.tail or '') != (b.tag, b.text or '', b.tail or ''):
+        return False
+    if dict(a.attrib) != dict(b.attrib) or len(a) != len(b):
+        return False
+    return all(_same_tree(child_a, child_b) for child_a, child_b in zip(a, b))
+
+
+class PackedRenderResult(RenderResult):
+    """Page groups built by PackedRenderer.build, with the size of what's on
+    each page so it can be centred"""
+    def __init__(self, page_groups, content_sizes, num_records, first_page_idx=0):
+        super().__init__(page_groups, num_records, first_page_idx)
+        self.content_sizes = content_sizes
+
+
+class PackedRenderer():
+    """Packs instances of one or more templates onto pages as tightly as their
+    sizes allow, instead of giving each template its own rows x columns grid.
+    Only real records are placed, so no page has blanks on it.
+
+    renderers maps each template's name to the Renderer that stamps it, which
+    keeps its own shared symbol. Their rows and columns are only used
+    to report how many pages the grid would have taken.
+    """
+    def __init__(self, renderers, svg):
+        self._renderers = renderers
+        self._svg = svg
+        # Templates can each have user units of their own, so everything is
+        # packed in the document's
+        self._uu_per_mm = svg.unittouu('1mm')
+        # Every renderer is normally given the same options, but if not, the
+        # widest bleed keeps all of them happy
+        self._bleed = max(renderer.options['bleed'] for renderer in renderers.values()) * self._uu_per_mm
+        self._log = logging.getLogger("FourPrintars")
 
-        for child in self._template.findall('./*'):
-            # print(child.tag, file=sys.stderr)
-            # print(child.get('id'), file=sys.stderr)
-            if "namedview" not in child.tag:
-                new_g.append(copy.deepcopy(child))
+    def render(self, entries):
+        self.add_to_document(self.build(entries))
+
+    def build(self, entries, progress=None, cancel_event=None, first_page_idx=0):
+        """Builds page groups for a dict of each template's name to its
+        (record, quantity) pairs, without touching the document. progress,
+        cancel_event and first_page_idx work as they do for Renderer.build"""
+        with phase('record_flattening') as p:
+            instances = []
+            sizes = []
+            counts = {}
+            for name, template_entries in entries.items():
+                size = self._document_size(self._renderers[name])
+                for record, quantity in template_entries:
+                    instances.extend(itertools.repeat((name, record), quantity))
+                counts[name] = sum(quantity for _, quantity in template_entries)
+                sizes.extend(itertools.repeat(size, counts[name]))
+            p.add(instances=len(instances))
+
+        last_page = self._svg.namedview.get_pages()[-1]
+        with phase('packing') as p:
+            try:
+                packed_pages = pack_shelves(sizes, last_page.width, last_page.height, self._bleed)
+            except LayoutError as e:
+                raise RendererError("Could not lay out pages", errors=e.errors)
+            p.add(instances=len(instances), pages=len(packed_pages))
+
+        self._report_packing(sizes, counts, len(packed_pages), last_page.width * last_page.height)
+
+        symbol_ids = set()
+        for name, renderer in self._renderers.items():
+            if symbol_id := renderer.prepare(counts.get(name, 0), symbol_ids):
+                symbol_ids.add(symbol_id)
+
+        page_groups = []
+        num_records_done = 0
+        with phase('pagination') as p:
+            for packed_page, page_group in zip(packed_pages,
+                    self._paginate(packed_pages, instances, first_page_idx)):
+                page_groups.append(page_group)
+                num_records_done += len(packed_page.placements)
+                if progress:
+                    progress(num_records_done, len(instances))
+                if cancel_event is not None and cancel_event.is_set() and len(page_groups) < len(packed_pages):
+                    raise RenderCancelled(f"Cancelled after {len(page_groups)} of {len(packed_pages)} pages")
+            p.add(pages=len(page_groups), instances=num_records_done)
+            p.count_nodes(*page_groups)
+
+        content_sizes = [(page.width, page.height) for page in packed_pages]
+        return PackedRenderResult(page_groups, content_sizes, len(instances), first_page_idx)
+
+    def add_to_document(self, result):
+        with phase('page_creation') as p:
+            renderer = next(iter(self._renderers.values()))
+            new_pages = renderer.add_pages(self._svg, result.page_idxs)
+
+            for renderer in self._renderers.values():
+                renderer.add_defs(self._svg)
+
+            for page, page_group, (width, height) in zip(new_pages, result.page_groups, result.content_sizes):
+                transform = inkex.transforms.Transform()
+                transform.add_translate(page.x + (page.width - width) / 2, page.y + (page.height - height) / 2)
+                page_group.set("transform", transform)
+                self._svg.add(page_group)
+            p.add(pages=len(new_pages))
+
+        self._log.info(f"Successfully rendered {result.num_records} records on {len(result.page_groups)} packed pages")
+
+    def _document_size(self, renderer):
+        """The width and height of one of renderer's instances, in the
+        document's user units"""
+        width_mm, height_mm = renderer.size_mm
+        return width_mm * self._uu_per_mm, height_mm * self._uu_per_mm
+
+    def _paginate(self, packed_pages, instances, first_page_idx):
+        # Copies of a record are clones of its first render, as in
+        # Renderer.paginate, but each template has its own last render since
+        # packing interleaves them
+        last_renders = {}
+        render_idx = 0
+        # Each instance is drawn in its template's user units
+        scales = {}
+        for name, renderer in self._renderers.items():
+            width, height = self._document_size(renderer)
+            cell_width, cell_height = renderer.cell_size
+            scales[name] = (width / cell_width, height / cell_height)
+
+        for page_offset, packed_page in enumerate(packed_pages):
+            idx = first_page_idx + page_offset
+            page_group = inkex.Group.new(f"Template Page Group {idx}", id=f"template_page_group_{idx}")
+            page_group.set(PAGE_INDEX_ATTR, str(idx))
+
+            for x, y, width, height in packed_page.shelves:
+                bleed_box = inkex.elements.Rectangle.new(x, y, width, height)
+                bleed_box.style['fill'] = 'black'
+                bleed_box.style['opacity'] = 1
+                bleed_box.style['fill-opacity'] = 1
+                page_group.append(bleed_box)
+
+            for instance_idx, x, y in packed_page.placements:
+                name, record = instances[instance_idx]
+                renderer = self._renderers[name]
+                last_record, last_render = last_renders.get(name, (None, None))
+                if record is last_record:
+                    render = renderer.clone(last_render, render_idx)
+                else:
+                    render = renderer.render_one_template(render_idx, record)
+                    last_renders[name] = (record, render)
+                transform = inkex.transforms.Transform()
+                transform.add_translate(x, y)
+                transform.add_scale(*scales[name])
+                render.set("transform", str(transform))
+                page_group.append(render)
+                render_idx += 1
 
-        template_tags = new_g.findall(".//*[@data-fp-value]")
-        for tag in template_tags:
-            for child in list(tag):
-                tag.remove(child)
-            tag.text = record[tag.attrib['data-fp-value']]
+            yield page_group
 
-        return new_g
+    def _report_packing(self, sizes, counts, num_pages, page_area):
+        if not sizes:
+            return
+        used_area = sum(width * height for width, height in sizes)
+        grid_pages = 0
+        for name, count in counts.items():
+            options = self._renderers[name].options
+            grid_pages += math.ceil(count / (options['rows'] * options['columns']))
+        self._log.info(f"Packed {len(sizes)} instances onto {num_pages} pages, "
+                f"{100 * used_area / (num_pages * page_area):.0f}% of the page area, "
+                f"where the rows x columns grid would take {grid_pages} pages, "
+                f"{100 * used_area / (grid_pages * page_area):.0f}% of the page area")
+
+
+# Evaluated by libxml2 rather than ElementPath, which would call inkex's
+# comparatively slow attribute lookup on every element in the fragment
+_EMPTY_SLOTS = etree.XPath(
+        "descendant-or-self::*[@data-fp-value][not(@data-fp-fill) or @data-fp-fill='text'][not(text())]"
+        " | descendant-or-self::*[@data-fp-fill='tspan']/*[not(text())]")
+
+
+def _parse_fragment(data):
+    fragment = etree.fromstring(data, parser=inkex.BaseElement.PARSER)
+    # Slots filled with an empty string come back from the parser with no
+    # text at all, which would serialize as a self-closing tag instead of an
+    # empty one
+    for tag in _EMPTY_SLOTS(fragment):
+        tag.text = ""
+    return fragment
+
+
+# Each worker process keeps its own renderer, so the compiled template is only
+# parsed once per process rather than once per chunk
+_page_worker = None
+
+
+def _init_page_worker(compiled_template, options):
+    global _page_worker
+    _page_worker = Renderer(CompiledTemplate.from_bytes(compiled_template), None, options)
+
+
+def _render_page_chunk(first_page_idx, pages):
+    options = _page_worker.options
+    bleed_box_width, bleed_box_height = _page_worker.bleed_box_size()
+    page_iter = _page_worker.paginate(
+                    pages,
+                    options['rows'],
+                    options['columns'],
+                    options['bleed'],
+                    bleed_box_width,
+                    bleed_box_height,
+                    first_page_idx=first_page_idx,
+                )
+    return [etree.tostring(page_group) for page_group in page_iter]
@@ -1,8 +1,7 @@
+import bisect
 import csv
 
-import gi
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from lib.column_store import read_snapshot, write_snapshot
 
 
 class OutputField:
@@ -12,23 +11,62 @@ class OutputField:
 
 
 class Table:
-    def __init__(self, name, source, headers, data):
+    """A table of strings, held as one sequence per column"""
+    def __init__(self, name, source, headers, columns):
         self.name = name
         self.source = source
         self.output_fields = []
         self.headers = headers
-        self.data = data
+        self.columns = columns
+        self.num_rows = len(columns[0]) if columns else 0
         self.header_map = {header: ii for ii, header in enumerate(headers)}
+        self._data = None
+        self._key_indexes = {}
+
+    @property
+    def data(self):
+        """The rows as a Gtk.ListStore, built the first time the UI asks for
+        it so that headless callers never need to import GTK"""
+        if self._data is None:
+            import gi
+            gi.require_version('Gtk', '3.0')
+            from gi.repository import Gtk
+
+            self._data = Gtk.ListStore(*([str] * len(self.headers)))
+            for row in zip(*self.columns):
+                self._data.append(row)
+        return self._data
+
+    def column(self, path):
+        return self.columns[self.header_map[path]]
+
+    def row(self, idx):
+        return [column[idx] for column in self.columns]
 
     @classmethod
     def from_csv(cls, name, csv_path):
-        with open(csv_path, 'r') as f:
+        """Loads a table from a CSV file, or from the snapshot saved alongside
+        it the last time that same version of the file was loaded"""
+        if snapshot := read_snapshot(csv_path):
+            headers, columns = snapshot
+            return cls(name, csv_path, headers, columns)
+
+        with open(csv_path, 'r', newline='') as f:
             reader = csv.reader(f)
             headers = next(reader)
-            data = Gtk.ListStore(*([str] * len(headers)))
-            for row in reader:
-                data.append(row)
-        return cls(name, csv_path, headers, data)
+            num_columns = len(headers)
+            padding = [''] * num_columns
+            rows = [row if len(row) == num_columns else (row + padding)[:num_columns]
+                    for row in reader]
+
+        columns = [list(column) for column in zip(*rows)] if rows else [[] for _ in headers]
+        write_snapshot(csv_path, headers, columns)
+        return cls(name, csv_path, headers, columns)
+
+    def shared_copy(self):
+        """A table backed by the same data, but with its own output fields, for
+        when several templates use it"""
+        return Table(self.name, self.source, self.headers, self.columns)
 
     @classmethod
     def from_nothing(cls, name):
@@ -37,3 +75,78 @@ class Table:
     def add_output_field(self, path, display_type):
         if all(of.path != path for of in self.output_fields):
             self.output_fields.append(OutputField(path, display_type))
+
+    def key_index(self, path):
+        """A KeyIndex over one column, built the first time it's asked for"""
+        if path not in self._key_indexes:
+            self._key_indexes[path] = KeyIndex(self.column(path))
+        return self._key_indexes[path]
+
+
+class KeyIndex:
+    """Finds the rows whose value in one column matches what's been typed so
+    far, without scanning the whole table on every keystroke.
+
+    Values are kept casefolded in a sorted array, so prefix matches come from a
+    binary search. Once three or more characters have been typed, a trigram
+    index also finds values containing the text anywhere. While the user keeps
+    typing, the previous query's matches are narrowed down instead of being
+    looked up again.
+    """
+    def __init__(self, values):
+        self._values = [value.casefold() for value in values]
+        self._sorted = sorted(range(len(self._values)), key=self._values.__getitem__)
+        self._sorted_values = [self._values[row_idx] for row_idx in self._sorted]
+
+        self._trigrams = {}
+        for row_idx, value in enumerate(self._values):
+            for trigram in {value[ii:ii + 3] for ii in range(len(value) - 2)}:
+                self._trigrams.setdefault(trigram, []).append(row_idx)
+
+        self._last_text = None
+        self._last_matches = None
+
+    def query(self, text, limit):
+        """Returns the indices of up to limit matching rows, prefix matches
+        first, each group in order of value"""
+        text = text.casefold()
+        if not text:
+            self._last_text = self._last_matches = None
+            return self._sorted[:limit]
+
+        if len(text) < 3:
+            # Too short for trigrams, and substring matches on a character or
+            # two are mostly noise, so stick to prefixes
+            self._last_text = self._last_matches = None
+            return self._prefix_matches(text)[:limit]
+
+        if self._last_text is not None and text.startswith(self._last_text):
+            # Some of the last query's prefix matches only contain the new
+            # text further in, so they move down among the other matches
+            other_matches = sorted((row_idx for row_idx in self._last_matches
+                    if text in self._values[row_idx] and not self._values[row_idx].startswith(text)),
+                    key=self._values.__getitem__)
+            matches = self._prefix_matches(text) + other_matches
+        else:
+            matches = self._substring_matches(text)
+
+        self._last_text = text
+        self._last_matches = matches
+        return matches[:limit]
+
+    def _prefix_matches(self, text):
+        start = bisect.bisect_left(self._sorted_values, text)
+        end = bisect.bisect_left(self._sorted_values, text + '\U0010ffff', start)
+        return self._sorted[start:end]
+
+    def _substring_matches(self, text):
+        postings = sorted((self._trigrams.get(text[ii:ii + 3], ()) for ii in range(len(text) - 2)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+
+        prefix_matches = self._prefix_matches(text)
+        candidates.difference_update(prefix_matches)
+        other_matches = sorted((row_idx for row_idx in candidates if text in self._values[row_idx]),
+                key=self._values.__getitem__)
+        return prefix_matches + other_matches
@@ -0,0 +1,491 @@
+import inkex
+import copy
+import json
+import re
+from lxml import etree
+
+# Elements whose text only makes sense alongside their descendants, so a slot
+# inside one has to carry the whole element with it
+TEXT_CONTAINERS = ('text', 'flowRoot')
+
+# Values that hide a slot filled with data-fp-fill="visible"
+HIDDEN_VALUES = ('', '0', 'false', 'no', 'hidden')
+
+# Things referenced by id that only need to be in a document once, however
+# many instances use them
+HOISTED_TAGS = ('linearGradient', 'radialGradient', 'clipPath', 'mask', 'filter',
+        'pattern', 'marker', 'solidcolor')
+
+# Inkscape and Sodipodi attributes that change how a drawing looks, so are
+# kept when compacting. Everything else in their namespaces only matters to
+# the editor
+KEPT_EDITOR_ATTRIBUTES = (inkex.addNS('role', 'sodipodi'),)
+EDITOR_NAMESPACES = (inkex.NSS['sodipodi'], inkex.NSS['inkscape'])
+
+# Prefix of the ids compact() gives elements that each instance needs its
+# own copy of, renumbered to template_instance_{idx}-... by stamp()
+LOCAL_ID_PREFIX = 'template_instance-'
+
+_URL_REFERENCE = re.compile(r'url\(\s*[\'"]?#([^)\'"\s]+)')
+_CSS_ID = re.compile(r'#([A-Za-z_][\w.-]*)')
+_HREFS = (inkex.addNS('href', 'xlink'), 'href')
+
+
+class TemplateError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.errors = kwargs.pop('errors')
+        super().__init__(*args, **kwargs)
+
+
+# Snapshots of compiled templates start with this, then a line of JSON
+# metadata, then the prototype's XML
+SNAPSHOT_MAGIC = b'FPTEMPLATE01\n'
+
+
+def template_fields(template):
+    """Returns a list of (table name, column, data-fp-type) for every
+    templated tag, and a list of problems with the tags it couldn't read"""
+    fields = []
+    errors = []
+    for tag in template.findall(".//*[@data-fp-value]"):
+        value = tag.attrib['data-fp-value']
+        table_name, sep, model_path = value.partition('/')
+        if not sep:
+            errors.append(f"data-fp-value \"{value}\" should be formatted as {{Table}}/{{Column}}")
+            continue
+        if 'data-fp-type' not in tag.attrib:
+            errors.append(f"{value} has no data-fp-type")
+            continue
+        fields.append((table_name, model_path, tag.attrib['data-fp-type']))
+    return fields, errors
+
+
+class CompiledTemplate():
+    """A template that has been analysed once, ready to be stamped out once per
+    record.
+
+    The static parts of the template are copied into a single prototype group,
+    with every data-fp-value tag already emptied. Stamping a record is then one
+    deepcopy of the prototype plus a direct write to each slot, found by its
+    position in the tree rather than by searching for it again.
+    """
+    def __init__(self, template):
+        template_root = template.getroot()
+        self.width_mm = inkex.units.convert_unit(template_root.get('width'), 'mm')
+        self.height_mm = inkex.units.convert_unit(template_root.get('height'), 'mm')
+        page_bbox = template_root.get_page_bbox()
+        self.cell_width = page_bbox.width
+        self.cell_height = page_bbox.height
+        self.fields, errors = template_fields(template)
+
+        self._prototype = inkex.Group.new("Template Instance", id="template_instance")
+
+        for child in template.findall('./*'):
+            if "namedview" not in child.tag:
+                self._prototype.append(copy.deepcopy(child))
+
+        for tag in self._prototype.findall(".//*[@data-fp-value]"):
+            fill = tag.get('data-fp-fill', 'text')
+            if fill == 'text':
+                for child in list(tag):
+                    tag.remove(child)
+            elif fill == 'tspan':
+                # The first line is kept, styling and all, as the pattern for
+                # every line of the value
+                if len(tag) == 0:
+                    errors.append(f"{tag.attrib['data-fp-value']} is filled by tspan but has no tspan to keep")
+                    continue
+                # Kept on the tag, so it survives the tag being moved or copied
+                if (line_step := _line_step(tag)) is not None:
+                    tag.set('data-fp-line-step', f"{line_step:g}")
+                for child in list(tag)[1:]:
+                    tag.remove(child)
+                tag.text = None
+                tag[0].text = None
+            elif not (fill.startswith(('attr:', 'style:')) or fill == 'visible'):
+                errors.append(f"{tag.attrib['data-fp-value']} has an unknown data-fp-fill \"{fill}\"")
+
+        if errors:
+            raise TemplateError("Invalid template", errors=errors)
+
+        # Ids compact() renamed, by their old ids
+        self._renamed = {}
+        self._find_slots()
+
+    def _find_slots(self):
+        # Slots nested inside another slot were emptied along with it, so only
+        # the survivors need a position
+        self._slots = [(self._path_to(tag), tag.attrib['data-fp-value'], _setter_for(tag, self._renamed))
+                for tag in self._prototype.findall(".//*[@data-fp-value]")]
+
+        # Left by compact(), and renumbered for each instance
+        self._local_ids = [self._path_to(tag)
+                for tag in self._prototype.xpath(f".//*[starts-with(@id, '{LOCAL_ID_PREFIX}')]")]
+        self._local_references = [(self._path_to(tag), attribute)
+                for tag in self._prototype.iter() if isinstance(tag.tag, str)
+                for attribute, value in tag.attrib.items() if f"#{LOCAL_ID_PREFIX}" in value]
+
+    def _metadata(self):
+        return {
+            'width_mm': self.width_mm,
+            'height_mm': self.height_mm,
+            'cell_width': self.cell_width,
+            'cell_height': self.cell_height,
+            'fields': self.fields,
+            'renamed_ids': self._renamed,
+        }
+
+    def copy(self):
+        """An independent copy, for a renderer to change as it likes"""
+        return self._from_parts(self._metadata(), copy.deepcopy(self._prototype))
+
+    def to_bytes(self):
+        header = SNAPSHOT_MAGIC + json.dumps(self._metadata()).encode('utf-8') + b'\n'
+        return header + etree.tostring(self._prototype)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Rebuilds a template saved by to_bytes, raising ValueError if data
+        isn't one"""
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise ValueError("Not a compiled template")
+        metadata, prototype = data[len(SNAPSHOT_MAGIC):].split(b'\n', 1)
+        try:
+            prototype = etree.fromstring(prototype, parser=inkex.BaseElement.PARSER)
+        except etree.XMLSyntaxError as e:
+            raise ValueError(str(e))
+        return cls._from_parts(json.loads(metadata), prototype)
+
+    @classmethod
+    def _from_parts(cls, metadata, prototype):
+        compiled = cls.__new__(cls)
+        compiled.width_mm = metadata['width_mm']
+        compiled.height_mm = metadata['height_mm']
+        compiled.cell_width = metadata['cell_width']
+        compiled.cell_height = metadata['cell_height']
+        compiled.fields = [tuple(field) for field in metadata['fields']]
+        compiled._renamed = metadata.get('renamed_ids', {})
+        compiled._prototype = prototype
+        compiled._find_slots()
+        return compiled
+
+    @property
+    def slot_names(self):
+        return [name for _, name, _ in self._slots]
+
+    def footprint(self):
+        """Returns the number of nodes and bytes each stamped instance costs"""
+        return (sum(1 for _ in self._prototype.iter()),
+                len(self.tostring()))
+
+    def tostring(self):
+        """The prototype instance, serialized"""
+        return etree.tostring(self._prototype)
+
+    def share_static_parts(self, symbol_id):
+        """Moves everything that doesn't depend on a record into a symbol, which
+        is returned for the caller to place in the document's defs. From then
+        on, each stamped instance is a <use> of that symbol plus the text
+        elements that hold slots.
+
+        Ancestors of the data-bearing elements are recreated as shallow copies
+        without ids, so transforms and inherited styles still apply. The data
+        is drawn on top of the static artwork rather than interleaved with it.
+        """
+        data_elements = []
+        for tag in self._prototype.findall(".//*[@data-fp-value]"):
+            data_element = tag
+            for ancestor in tag.iterancestors():
+                if ancestor is self._prototype:
+                    break
+                if ancestor.TAG in TEXT_CONTAINERS:
+                    data_element = ancestor
+            if data_element not in data_elements:
+                data_elements.append(data_element)
+        # A slot inside another slot's element moves along with it
+        data_element_set = set(data_elements)
+        data_elements = [data_element for data_element in data_elements
+                if not any(ancestor in data_element_set for ancestor in data_element.iterancestors())]
+
+        shared_prototype = inkex.Group.new("Template Instance", id="template_instance")
+        symbol = inkex.elements.Symbol.new(id=symbol_id)
+        symbol.style['overflow'] = 'visible'
+        shared_prototype.append(inkex.elements.Use.new(symbol, 0, 0))
+
+        ancestor_copies = {self._prototype: shared_prototype}
+        for data_element in data_elements:
+            ancestors = list(data_element.iterancestors())
+            parent_copy = shared_prototype
+            for ancestor in reversed(ancestors[:ancestors.index(self._prototype)]):
+                if ancestor not in ancestor_copies:
+                    ancestor_copy = ancestor.makeelement(ancestor.tag, ancestor.attrib)
+                    for attr in ('id', 'inkscape:label', 'inkscape:groupmode'):
+                        ancestor_copy.set(attr, None)
+                    parent_copy.append(ancestor_copy)
+                    ancestor_copies[ancestor] = ancestor_copy
+                parent_copy = ancestor_copies[ancestor]
+            data_element.getparent().remove(data_element)
+            parent_copy.append(data_element)
+
+        for child in list(self._prototype):
+            symbol.append(child)
+
+        self._prototype = shared_prototype
+        self._find_slots()
+        return symbol
+
+    def compact(self, prefix, symbol=None):
+        """Trims each instance down to what it needs to draw. Returns the
+        elements to go in the document's defs, once however many instances
+        there are.
+
+        Gradients, clip paths, filters and the like that the template
+        references by id are taken out of the prototype to be shared, renamed
+        {prefix}-{old id} so they can't clash with another template's. So are
+        stylesheets, and the rest of the template's defs, which records can
+        still refer to by their old ids through attr: and style: fills. Other
+        ids nothing refers to are dropped, along with metadata and attributes
+        only Inkscape's editor reads. Anything else the template refers to by
+        id gets an id stamp() numbers per instance, so every instance refers
+        to its own copy rather than the first one's.
+
+        symbol, if static parts have been shared, is compacted alongside the
+        prototype, and what it refers to is renamed in place.
+        """
+        roots = [self._prototype] if symbol is None else [self._prototype, symbol]
+        elements = [element for root in roots for element in root.iter()]
+
+        for element in elements:
+            if not isinstance(element.tag, str) or etree.QName(element).localname == 'metadata':
+                element.getparent().remove(element)
+                continue
+            for attribute in list(element.attrib):
+                namespace = etree.QName(attribute).namespace
+                if namespace in EDITOR_NAMESPACES and attribute not in KEPT_EDITOR_ATTRIBUTES:
+                    del element.attrib[attribute]
+        elements = [element for root in roots for element in root.iter()]
+
+        referenced = set()
+        kept = set()
+        for element in elements:
+            if etree.QName(element).localname == 'style':
+                # Whatever a stylesheet picks out by id has to keep it
+                kept.update(_CSS_ID.findall(element.text or ''))
+                continue
+            for attribute, value in element.attrib.items():
+                if attribute in _HREFS and value.startswith('#'):
+                    referenced.add(value[1:])
+                elif 'url(' in value:
+                    referenced.update(_URL_REFERENCE.findall(value))
+        referenced -= kept
+
+        in_symbol = set(symbol.iter()) if symbol is not None else set()
+        renames = {}
+        local_renames = {}
+        hoisted = []
+        for element in elements:
+            if element in roots:
+                continue
+            element_id = element.get('id')
+            localname = etree.QName(element).localname
+            inside_hoisted = any(ancestor in hoisted for ancestor in element.iterancestors())
+            in_defs = etree.QName(element.getparent()).localname == 'defs'
+            shareable = in_defs or (localname in HOISTED_TAGS and element_id in referenced)
+
+            if localname == 'style':
+                element.attrib.pop('id', None)
+                if not inside_hoisted:
+                    hoisted.append(element)
+            elif not inside_hoisted and shareable:
+                # Everything in the template's defs is kept, even if the
+                # template doesn't use it, since records may refer to it
+                hoisted.append(element)
+                if element_id is not None and element_id not in kept:
+                    renames[element_id] = f"{prefix}-{element_id}"
+            elif element_id in kept:
+                pass
+            elif element_id not in referenced:
+                element.attrib.pop('id', None)
+            elif inside_hoisted or element in in_symbol:
+                renames[element_id] = f"{prefix}-{element_id}"
+            else:
+                local_renames[element_id] = f"{LOCAL_ID_PREFIX}{len(local_renames)}"
+
+        self._renamed = dict(renames)
+        renames.update(local_renames)
+
+        for element in hoisted:
+            element.getparent().remove(element)
+
+        for element in elements:
+            # Through lxml, so styles are left exactly as they were written
+            if (element_id := element.get('id')) in renames:
+                etree.ElementBase.set(element, 'id', renames[element_id])
+            for attribute, value in element.attrib.items():
+                if attribute in _HREFS and value[1:] in renames:
+                    etree.ElementBase.set(element, attribute, f"#{renames[value[1:]]}")
+                elif 'url(' in value:
+                    etree.ElementBase.set(element, attribute, _rename_references(value, renames))
+
+        # What's left of the template's defs is unused
+        for root in roots:
+            for defs in root.xpath(".//svg:defs", namespaces=inkex.NSS):
+                defs.getparent().remove(defs)
+
+        self._find_slots()
+        return hoisted
+
+    def _path_to(self, tag):
+        path = []
+        while tag is not self._prototype:
+            parent = tag.getparent()
+            path.append(parent.index(tag))
+            tag = parent
+        return tuple(reversed(path))
+
+    def stamp(self, idx, record):
+        new_g = copy.deepcopy(self._prototype)
+        new_g.set("id", f"template_instance_{idx}")
+        new_g.set("inkscape:label", f"Template Instance {idx}")
+
+        for path, name, setter in self._slots:
+            tag = new_g
+            for child_idx in path:
+                tag = tag[child_idx]
+            setter(tag, record[name])
+
+        # After the slots, since filling a style rewrites the whole attribute
+        if self._local_ids:
+            self._number_local_ids(new_g, LOCAL_ID_PREFIX, f"template_instance_{idx}-")
+        return new_g
+
+    def clone(self, instance, idx):
+        """Copies an already stamped instance, renumbered as instance idx"""
+        return self.renumber(copy.deepcopy(instance), idx)
+
+    def renumber(self, instance, idx):
+        if self._local_ids:
+            self._number_local_ids(instance, f"{instance.get('id')}-", f"template_instance_{idx}-")
+        instance.set("id", f"template_instance_{idx}")
+        instance.set("inkscape:label", f"Template Instance {idx}")
+        return instance
+
+    def _number_local_ids(self, instance, old_prefix, new_prefix):
+        for path in self._local_ids:
+            tag = instance
+            for child_idx in path:
+                tag = tag[child_idx]
+            etree.ElementBase.set(tag, 'id', etree.ElementBase.get(tag, 'id').replace(old_prefix, new_prefix, 1))
+        for path, attribute in self._local_references:
+            tag = instance
+            for child_idx in path:
+                tag = tag[child_idx]
+            etree.ElementBase.set(tag, attribute,
+                    etree.ElementBase.get(tag, attribute).replace(f"#{old_prefix}", f"#{new_prefix}"))
+
+
+# Each slot is filled by a setter chosen by its data-fp-fill when the template
+# is compiled, with anything it needs from the prototype worked out up front.
+# Setters write through lxml directly, skipping inkex's attribute handling
+
+def _rename_references(value, renames):
+    """Points the url(#...) references in value at renamed ids"""
+    def rename(match):
+        old_id = match.group(1)
+        return match.group(0).replace(f"#{old_id}", f"#{renames.get(old_id, old_id)}")
+    return _URL_REFERENCE.sub(rename, value)
+
+
+def _setter_for(tag, renamed):
+    fill = tag.get('data-fp-fill', 'text')
+    if fill == 'text':
+        return _set_text
+    if fill == 'tspan':
+        return _lines_setter(tag)
+    if fill.startswith('attr:'):
+        return _renaming_setter(_attribute_setter(inkex.addNS(fill[len('attr:'):])), renamed)
+    if fill.startswith('style:'):
+        return _renaming_setter(_style_setter(tag, fill[len('style:'):]), renamed)
+    return _visibility_setter(tag)
+
+
+def _renaming_setter(setter, renamed):
+    # Records refer to the template's defs by the ids they had in the
+    # template, which compacting may have changed
+    if not renamed:
+        return setter
+
+    def set_renamed(tag, value):
+        if '#' in value:
+            if value.startswith('#') and value[1:] in renamed:
+                value = f"#{renamed[value[1:]]}"
+            else:
+                value = _rename_references(value, renamed)
+        setter(tag, value)
+    return set_renamed
+
+
+def _set_text(tag, value):
+    tag.text = value
+
+
+def _line_step(tag):
+    """How far apart the template's own lines are, if it has two to go by"""
+    try:
+        return float(tag[1].get('y')) - float(tag[0].get('y'))
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _lines_setter(tag):
+    # Each extra line is a copy of the first, moved down by the template's
+    # line spacing if it has one. Otherwise Inkscape lays the lines out itself
+    try:
+        line_step = float(tag.get('data-fp-line-step'))
+        first_y = float(tag[0].get('y'))
+    except (TypeError, ValueError):
+        line_step = None
+
+    def set_lines(tag, value):
+        lines = value.split('\n')
+        first_line = tag[0]
+        first_line.text = lines[0]
+        for ii, line in enumerate(lines[1:], 1):
+            new_line = copy.deepcopy(first_line)
+            new_line.text = line
+            if line_step:
+                etree.ElementBase.set(new_line, 'y', f"{first_y + ii * line_step:g}")
+            tag.append(new_line)
+    return set_lines
+
+
+def _attribute_setter(attribute):
+    def set_attribute(tag, value):
+        etree.ElementBase.set(tag, attribute, value)
+    return set_attribute
+
+
+def _style_setter(tag, prop):
+    style = inkex.Style(tag.get('style', ''))
+    style.pop(prop, None)
+    unset_style = str(style)
+    prefix = f"{style};" if style else ""
+
+    def set_style(tag, value):
+        # An empty value, as blank padding copies have, leaves the property
+        # out rather than writing invalid CSS like "fill:"
+        etree.ElementBase.set(tag, 'style', f"{prefix}{prop}:{value}" if value else unset_style)
+    return set_style
+
+
+def _visibility_setter(tag):
+    style = inkex.Style(tag.get('style', ''))
+    style.pop('display', None)
+    shown_style = str(style)
+    style['display'] = 'none'
+    hidden_style = str(style)
+
+    def set_visibility(tag, value):
+        visible = value.strip().casefold() not in HIDDEN_VALUES
+        etree.ElementBase.set(tag, 'style', shown_style if visible else hidden_style)
+    return set_visibility
@@ -0,0 +1,72 @@
+import hashlib
+import io
+import logging
+import os
+import os.path
+
+_log = logging.getLogger("FourPrintars.template_registry")
+
+
+class TemplateRegistry:
+    """Compiled templates, each compiled once per version of its file.
+
+    Templates are kept in memory for the session, keyed by a hash of the
+    file's contents, so loading the same file twice - or the same template
+    from two paths - reuses the first compile. With a cache_dir, compiled
+    templates are also saved there as snapshots and picked up by later
+    sessions without parsing or analysing the SVG again. Failing to read or
+    write a snapshot isn't an error - the template is just compiled again.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._templates = {}
+
+    def load(self, path):
+        # Imported here rather than above, so that making a registry doesn't
+        # import inkex and hold up the first dialog
+        import inkex
+        from lib.template import CompiledTemplate
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha256(data).hexdigest()
+
+        if key in self._templates:
+            return self._templates[key]
+
+        compiled = self._read_snapshot(key)
+        if compiled is None:
+            compiled = CompiledTemplate(inkex.elements.load_svg(io.BytesIO(data)))
+            self._write_snapshot(key, compiled)
+
+        self._templates[key] = compiled
+        return compiled
+
+    def _snapshot_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.fptemplate")
+
+    def _read_snapshot(self, key):
+        if self.cache_dir is None:
+            return None
+        from lib.template import CompiledTemplate
+        path = self._snapshot_path(key)
+        try:
+            with open(path, 'rb') as f:
+                compiled = CompiledTemplate.from_bytes(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        _log.debug(f"Loaded compiled template {path}")
+        return compiled
+
+    def _write_snapshot(self, key, compiled):
+        if self.cache_dir is None:
+            return
+        path = self._snapshot_path(key)
+        tmp_path = path + '.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(compiled.to_bytes())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            _log.debug(f"Couldn't write compiled template {path}: {e}")
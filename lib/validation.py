@@ -0,0 +1,147 @@
+import logging
+import time
+
+# How each field can be shown in the interface, as set by data-fp-type
+DISPLAY_TYPES = ('key', 'editable', 'displayonly', 'hidden')
+
+# Columns an inventory has besides the template's fields
+QUANTITY_FIELD = 'Quantity'
+
+# Leeway when comparing sizes, so a layout that exactly fills the page isn't
+# turned away over rounding
+_TOLERANCE_MM = 1e-6
+
+_log = logging.getLogger("FourPrintars.validation")
+
+
+class ValidationError(Exception):
+    def __init__(self, *args, **kwargs):
+        self.errors = kwargs.pop('errors')
+        super().__init__(*args, **kwargs)
+
+
+def parse_options(options):
+    """Parses rows, columns and bleed as typed in. Returns the parsed options
+    and a list of problems with them"""
+    if set(options.keys()) != set(['rows', 'columns', 'bleed']):
+        raise ValueError("Options don't make sense")
+
+    parsed = {}
+    errors = []
+
+    try:
+        parsed['rows'] = int(options['rows'])
+        if parsed['rows'] <= 0:
+            raise ValueError(parsed['rows'])
+    except ValueError:
+        errors.append(f"Could not parse \"{options['rows']}\" as a number of rows. Please input a whole number")
+
+    try:
+        parsed['columns'] = int(options['columns'])
+        if parsed['columns'] <= 0:
+            raise ValueError(parsed['columns'])
+    except ValueError:
+        errors.append(f"Could not parse \"{options['columns']}\" as a number of columns. Please input a whole number")
+
+    try:
+        parsed['bleed'] = float(options['bleed'])
+        if parsed['bleed'] < 0:
+            raise ValueError(parsed['bleed'])
+    except ValueError:
+        errors.append(f"Could not parse \"{options['bleed']}\" as a bleed width. Please input a number (decimals are allowed)")
+
+    return parsed, errors
+
+
+def check_fields(template, tables):
+    """Problems with a compiled template's fields, given the tables loaded
+    for it: unknown data-fp-types, columns its tables don't have, and keys
+    that have no table to look anything up in"""
+    errors = []
+    # A field can be on more than one tag, but only needs reporting once
+    for table_name, path, display_type in dict.fromkeys(map(tuple, template.fields)):
+        if display_type not in DISPLAY_TYPES:
+            errors.append(f"{table_name}/{path} has an unknown data-fp-type \"{display_type}\". "
+                    f"Please use one of {', '.join(DISPLAY_TYPES)}")
+
+        table = tables.get(table_name)
+        if table is None or not table.header_map:
+            if display_type == 'key':
+                errors.append(f"{table_name}/{path} is a key, but there's no {table_name or 'unnamed'} table to look it up in")
+        elif path not in table.header_map:
+            errors.append(f"The {table_name} table has no {path} column")
+    return errors
+
+
+def check_inventory(template, tables, columns):
+    """Problems rendering a template from an inventory with the given columns.
+    Every field has to be either a column of its own or looked up by a key
+    column from its table"""
+    errors = []
+    if QUANTITY_FIELD not in columns:
+        errors.append(f"The inventory has no {QUANTITY_FIELD} column")
+
+    missing = {}
+    keys = {}
+    for table_name, path, display_type in template.fields:
+        field = f"{table_name}/{path}"
+        if field not in columns:
+            missing.setdefault(table_name, []).append(field)
+        elif display_type == 'key':
+            keys.setdefault(table_name, []).append(field)
+
+    for table_name, fields in missing.items():
+        table = tables.get(table_name)
+        if table is None or not table.header_map:
+            # Fields that aren't backed by a table are left blank
+            continue
+        if not keys.get(table_name):
+            errors.append(f"The inventory has no key column to look up {table_name} by, "
+                    f"so can't fill in {', '.join(dict.fromkeys(fields))}")
+    return errors
+
+
+def check_layout(template, svg, options, packed=False):
+    """Problems fitting a template onto the document's last page, which every
+    new page copies: either rows x columns of it with bleed between and
+    around them, or, when packed, just one"""
+    parsed, errors = parse_options(options)
+    if errors:
+        return errors
+
+    page = svg.namedview.get_pages()[-1]
+    page_width = svg.uutounit(page.width, 'mm')
+    page_height = svg.uutounit(page.height, 'mm')
+    bleed = parsed['bleed']
+
+    if packed:
+        width = template.width_mm + 2 * bleed
+        height = template.height_mm + 2 * bleed
+        layout = f"A {template.width_mm:g}x{template.height_mm:g}mm template with {bleed:g}mm bleed"
+    else:
+        rows = parsed['rows']
+        columns = parsed['columns']
+        width = (template.width_mm + bleed) * columns + bleed
+        height = (template.height_mm + bleed) * rows + bleed
+        layout = (f"{columns} column{'s' if columns != 1 else ''} by {rows} row{'s' if rows != 1 else ''} "
+                f"of a {template.width_mm:g}x{template.height_mm:g}mm template with {bleed:g}mm bleed")
+
+    if width > page_width + _TOLERANCE_MM or height > page_height + _TOLERANCE_MM:
+        errors.append(f"{layout} needs {width:g}x{height:g}mm, "
+                f"which doesn't fit on a {page_width:g}x{page_height:g}mm page")
+    return errors
+
+
+def validate(template, tables, svg, options, columns=None, packed=False):
+    """Checks everything about a render that can be checked before it starts,
+    raising a ValidationError with every problem found. columns, if given,
+    are the inventory's columns, for renders from an inventory file"""
+    started = time.perf_counter()
+    errors = check_fields(template, tables)
+    errors += check_layout(template, svg, options, packed)
+    if columns is not None:
+        errors += check_inventory(template, tables, set(columns))
+    _log.debug(f"Validated the render in {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    if errors:
+        raise ValidationError("Invalid render", errors=errors)
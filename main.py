@@ -1,27 +1,45 @@
+from lib import instrumentation
+from lib.config import ConfigStore
 from lib.handlers.main_handler import MainHandler
 from lib.handlers.entry_table_handler import EntryTableHandler
-from lib.renderer import Renderer, RendererError
+from lib.handlers.key_completion_handler import KeyCompletionHandler
+from lib.inventory import InventoryStore, InventoryError, RecordResolver, load_inventory
+from lib.inventory_model import InventoryTreeModel
+from lib.template_registry import TemplateRegistry
 from lib.table import Table
+from lib.validation import ValidationError, check_fields, validate
 from lib.list_store_log_handler import ListStoreLogHandler
 
 import os
 import os.path
-import yaml
 import logging
+import logging.handlers
+import math
 import traceback
+import threading
+import time
 import sys
 from collections import defaultdict
 
-import inkex
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 
+# How many messages the status panel keeps before dropping the oldest
+STATUS_LOG_LINES = 1000
 
-class FourPrintars(inkex.GenerateExtension):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+# Minimum number of seconds between progress bar updates while rendering
+RENDER_PROGRESS_INTERVAL = 0.1
 
+# How many unmatched keys to list after importing orders
+UNMATCHED_KEYS_SHOWN = 20
+
+# Resolution of exported PNGs unless export_dpi says otherwise
+EXPORT_DPI = 300
+
+
+class FourPrintars:
+    def __init__(self):
         self._log = logging.getLogger("FourPrintars")
         self._log.setLevel(logging.DEBUG)
         logging.basicConfig(stream=sys.stderr)
@@ -35,13 +53,29 @@ class FourPrintars(inkex.GenerateExtension):
         }
         self.outputs = {}
         self.records = None
-        self.record_index_map = {}
+        self.inventory_model = None
+        self.entry_table_handlers = {}
+        self.render_thread = None
+        self.render_cancel_event = None
+        self.render_started = None
+        self.preload_thread = None
+        self.preload_path = None
+        self.preload_template_ready = threading.Event()
+        self.preloaded_tables = {}
         self.config_filepath = os.path.join(os.environ['HOME'], '.config', 'FourPrintars.yaml')
+        self.template_registry = TemplateRegistry(
+                os.path.join(os.path.dirname(self.config_filepath), 'FourPrintars.templates'))
 
-        self.init_gtk()
+        # The main window isn't built until a template has been picked, so
+        # anything logged before then is held until the status panel exists
+        self.startup_log_buffer = logging.handlers.MemoryHandler(STATUS_LOG_LINES,
+                flushLevel=logging.CRITICAL + 1)
+        self._log.addHandler(self.startup_log_buffer)
 
         self.config = self.load_config()
-        self.save_config()
+        # Only actually writes anything on the first run, to create the file
+        self.config.flush()
+        self.init_logging()
 
     def show_msg(self, text, message_type=Gtk.MessageType.INFO):
         dialog = Gtk.MessageDialog(
@@ -64,19 +98,13 @@ class FourPrintars(inkex.GenerateExtension):
                 ctypes.windll.kernel32.SetFileAttributesW(
                         config_dir.encode('utf-16le'), FILE_ATTRIBUTE_HIDDEN)
 
-        if not os.path.exists(self.config_filepath):
+        config = ConfigStore(self.config_filepath)
+        if not config.load():
             self.show_msg(f"This appears to be your first time running FourPrintars.\n\nYour config file lives at {self.config_filepath} - I've initialised an empty one for you.")
             self._log.info(f"Created new config at {self.config_filepath}")
-            return {}
         else:
-            with open(self.config_filepath, 'r') as f:
-                config = yaml.load(f)
             self._log.info(f"Loaded config from {self.config_filepath}")
-            return config
-
-    def save_config(self):
-        with open(self.config_filepath, 'w') as f:
-            yaml.dump(self.config, f)
+        return config
 
     def init_gtk(self):
         handler = MainHandler(self)
@@ -91,6 +119,14 @@ class FourPrintars(inkex.GenerateExtension):
         self.data_entries['fixed']['columns'] = self.builder.get_object('inventory_columns')
         self.data_entries['fixed']['bleed'] = self.builder.get_object('inventory_bleed')
         self.data_entries['fixed']['quantity'] = self.builder.get_object('add_entry_quantity')
+        self.data_entries['fixed']['shared_defs'] = self.builder.get_object('inventory_shared_defs')
+        self.data_entries['fixed']['incremental'] = self.builder.get_object('inventory_incremental')
+        self.data_entries['fixed']['compact'] = self.builder.get_object('inventory_compact')
+
+        self.render_button = self.builder.get_object('render_button')
+        self.render_stop_button = self.builder.get_object('render_stop')
+        self.export_button = self.builder.get_object('export_button')
+        self.render_progress = self.builder.get_object('render_progress')
 
         log_store = self.builder.get_object('status_entry_store')
         scrolling_window = self.builder.get_object('inventory_status_window')
@@ -100,52 +136,277 @@ class FourPrintars(inkex.GenerateExtension):
             adj.set_value(adj.get_upper() - adj.get_page_size())
 
         self.builder.get_object('inventory_status').connect('size-allocate', autoscroll)
-        self._log.addHandler(ListStoreLogHandler(log_store))
+        self.status_log_handler = ListStoreLogHandler(log_store, max_lines=STATUS_LOG_LINES)
+        self.status_log_handler.setLevel(self.config.get('status_log_level') or logging.INFO)
+        self._log.addHandler(self.status_log_handler)
+
+        self._log.removeHandler(self.startup_log_buffer)
+        self.startup_log_buffer.setTarget(self.status_log_handler)
+        # Closing flushes everything buffered so far into the status panel
+        self.startup_log_buffer.close()
+
+    def init_logging(self):
+        # The status panel only shows what the user picked (INFO by default),
+        # while everything down to DEBUG goes to a log file next to the config
+        log_filepath = os.path.join(os.path.dirname(self.config_filepath), 'FourPrintars.log')
+        file_handler = logging.handlers.RotatingFileHandler(
+                log_filepath, maxBytes=5 * 1024 * 1024, backupCount=2)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        self._log.addHandler(file_handler)
+        self._log.debug(f"Logging to {log_filepath}")
+
+        # Phase timings are cheap enough to keep on unless asked not to, but
+        # tracing memory slows rendering down, so that's only on request
+        if self.config.get('instrumentation') is not False:
+            instrumentation.enable(trace_memory=bool(self.config.get('trace_memory')))
 
     def save_render_options(self, render_options):
         template_filename = os.path.basename(self.template_path)
         for key, value in render_options.items():
-            self.update_config('default_render_option', template_filename, key, value)
+            self.config.set('default_render_option', template_filename, key, value)
 
     def load_render_options(self):
         template_filename = os.path.basename(self.template_path)
-        if rows := self.get_config('default_render_option', template_filename, 'rows'):
+        if rows := self.config.get('default_render_option', template_filename, 'rows'):
             self.data_entries['fixed']['rows'].set_text(rows)
 
-        if columns := self.get_config('default_render_option', template_filename, 'columns'):
+        if columns := self.config.get('default_render_option', template_filename, 'columns'):
             self.data_entries['fixed']['columns'].set_text(columns)
 
-        if bleed := self.get_config('default_render_option', template_filename, 'bleed'):
+        if bleed := self.config.get('default_render_option', template_filename, 'bleed'):
             self.data_entries['fixed']['bleed'].set_text(bleed)
 
     def render(self):
+        """Starts rendering the inventory on a worker thread. The document is
+        only changed once every page has been built, back on the main loop, so
+        stopping a render part way through leaves it untouched"""
+        # Not needed until the first render, so kept out of startup
+        from lib.renderer import Renderer, RendererError
+
+        if self.render_thread is not None:
+            return
+
         render_options = {
             'rows': self.data_entries['fixed']['rows'].get_text(),
             'columns': self.data_entries['fixed']['columns'].get_text(),
             'bleed': self.data_entries['fixed']['bleed'].get_text(),
         }
         try:
-            renderer = Renderer(self.template, self.svg, render_options)
+            # Anything that would stop the render part way through is caught now
+            validate(self.template, self.tables, self.svg, render_options)
+            shared_defs = self.data_entries['fixed']['shared_defs'].get_active()
+            incremental = self.data_entries['fixed']['incremental'].get_active()
+            compact = self.data_entries['fixed']['compact'].get_active()
+            renderer = Renderer(self.template, self.svg, render_options, shared_defs=shared_defs,
+                    incremental=incremental, compact=compact,
+                    template_name=os.path.basename(self.template_path))
             self.save_render_options(render_options)
+            self.config.flush()
+        except (RendererError, ValidationError) as e:
+            msg = "Failed to render. Here's why:\n" + "\n".join(e.errors)
+            self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+            return
 
-            flattened_records = []
-            for record in self.records:
-                record = tuple(record)
-                record_as_dict = {field_name: record[field_idx] for field_name,
-                        field_idx in self.record_index_map.items()}
+        entries = [(record, record.quantity) for record in self.records]
+        self.render_cancel_event = threading.Event()
+        self.render_started = time.monotonic()
+        self.set_rendering(True)
+        self.render_progress.set_fraction(0)
+        self.render_progress.set_text("Starting render")
 
-                quantity = record_as_dict.pop('Quantity')
-                flattened_records += [record_as_dict] * int(quantity)
+        self.render_thread = threading.Thread(target=self.render_in_background,
+                args=(renderer, entries, self.render_cancel_event), daemon=True)
+        self.render_thread.start()
 
-            renderer.render(flattened_records)
-            self.show_msg("Rendering finished!\n\nYou won't be able to see the results until you close Four Printars")
+    def render_in_background(self, renderer, entries, cancel_event):
+        # Runs on the render thread, so GTK is only ever touched from idle
+        # callbacks handed back to the main loop
+        from lib.renderer import RendererError, RenderCancelled
+
+        last_update = 0
+
+        def progress(num_done, num_total):
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= RENDER_PROGRESS_INTERVAL or num_done == num_total:
+                last_update = now
+                GLib.idle_add(self.update_render_progress, num_done, num_total)
 
+        try:
+            result = renderer.build(entries, progress=progress, cancel_event=cancel_event)
+        except RenderCancelled as e:
+            self._log.debug(str(e))
+            GLib.idle_add(self.finish_render, renderer, None, None)
         except RendererError as e:
-            msg = "Failed to render. Here's why:\n" + "\n".join(e.errors)
-            self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+            GLib.idle_add(self.finish_render, renderer, None,
+                    "Failed to render. Here's why:\n" + "\n".join(e.errors))
         except Exception:
-            msg = "Something went terribly wrong!\n" + traceback.format_exc()
+            GLib.idle_add(self.finish_render, renderer, None,
+                    "Something went terribly wrong!\n" + traceback.format_exc())
+        else:
+            GLib.idle_add(self.finish_render, renderer, result, None)
+
+    def update_render_progress(self, num_done, num_total):
+        if self.render_thread is None or self.render_cancel_event.is_set():
+            return False
+
+        elapsed = time.monotonic() - self.render_started
+        rate = num_done / elapsed if elapsed > 0 else 0
+        text = f"{num_done}/{num_total} records, {rate:.0f} records/s"
+        if 0 < num_done < num_total and rate > 0:
+            text += f", about {math.ceil((num_total - num_done) / rate)}s left"
+        self.render_progress.set_fraction(num_done / num_total if num_total else 1)
+        self.render_progress.set_text(text)
+        return False
+
+    def finish_render(self, renderer, result, error_msg):
+        self.render_thread = None
+        self.set_rendering(False)
+
+        if error_msg is not None:
+            self.render_progress.set_text("Render failed")
+            self.show_msg(error_msg, message_type=Gtk.MessageType.ERROR)
+        elif result is None:
+            self.render_progress.set_fraction(0)
+            self.render_progress.set_text("Render stopped")
+            self._log.info("Render stopped, the document has not been changed")
+        else:
+            self.render_progress.set_text("Adding pages to the document")
+            try:
+                renderer.add_to_document(result)
+                if renderer.incremental:
+                    renderer.remove_pages_outside(result.first_page_idx,
+                            result.first_page_idx + result.num_pages)
+            except Exception:
+                msg = "Something went terribly wrong!\n" + traceback.format_exc()
+                self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+                return False
+
+            elapsed = time.monotonic() - self.render_started
+            self.render_progress.set_fraction(1)
+            self.render_progress.set_text(f"Rendered {result.num_records} records in {elapsed:.1f}s")
+            instrumentation.log_summary()
+            self.show_msg("Rendering finished!\n\nYou won't be able to see the results until you close Four Printars")
+
+        return False
+
+    def export_pages(self):
+        """Exports the rendered pages as print-ready files into a folder the
+        user picks, on a worker thread, sharing the render progress bar"""
+        from lib.export import PageExporter, ExportError
+
+        if self.render_thread is not None:
+            return
+
+        dialog = Gtk.FileChooserDialog(
+            title="Please choose a folder to export pages into",
+            action=Gtk.FileChooserAction.SELECT_FOLDER
+        )
+        dialog.add_buttons(
+            Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+            Gtk.STOCK_OPEN, Gtk.ResponseType.OK,
+        )
+
+        if default_export_dir := self.config.get('default_export_dir'):
+            dialog.set_current_folder(default_export_dir)
+
+        response = dialog.run()
+        export_dir = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        self.config.set('default_export_dir', export_dir)
+        self.config.flush()
+
+        try:
+            exporter = PageExporter(self.svg, export_dir,
+                    formats=self.config.get('export_formats') or ['pdf'],
+                    converter=self.config.get('export_converter') or 'auto',
+                    workers=self.config.get('export_workers'),
+                    dpi=self.config.get('export_dpi') or EXPORT_DPI)
+        except ExportError as e:
+            msg = "Failed to export. Here's why:\n" + "\n".join(e.errors)
             self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+            return
+
+        template_stem = os.path.splitext(os.path.basename(self.template_path))[0]
+        merged_path = os.path.join(export_dir, f"{template_stem}.pdf")
+        self.render_cancel_event = threading.Event()
+        self.render_started = time.monotonic()
+        self.set_rendering(True)
+        self.render_progress.set_fraction(0)
+        self.render_progress.set_text("Starting export")
+
+        self.render_thread = threading.Thread(target=self.export_in_background,
+                args=(exporter, merged_path, self.render_cancel_event), daemon=True)
+        self.render_thread.start()
+
+    def export_in_background(self, exporter, merged_path, cancel_event):
+        from lib.export import ExportError, ExportCancelled
+
+        last_update = 0
+
+        def progress(num_done, num_total):
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= RENDER_PROGRESS_INTERVAL or num_done == num_total:
+                last_update = now
+                GLib.idle_add(self.update_export_progress, num_done, num_total)
+
+        try:
+            result = exporter.export(merged_path=merged_path, progress=progress, cancel_event=cancel_event)
+        except ExportCancelled as e:
+            self._log.debug(str(e))
+            GLib.idle_add(self.finish_export, None, None)
+        except ExportError as e:
+            GLib.idle_add(self.finish_export, None,
+                    "Failed to export. Here's why:\n" + "\n".join(e.errors))
+        except Exception:
+            GLib.idle_add(self.finish_export, None,
+                    "Something went terribly wrong!\n" + traceback.format_exc())
+        else:
+            GLib.idle_add(self.finish_export, result, None)
+
+    def update_export_progress(self, num_done, num_total):
+        if self.render_thread is None or self.render_cancel_event.is_set():
+            return False
+
+        self.render_progress.set_fraction(num_done / num_total if num_total else 1)
+        self.render_progress.set_text(f"Exported {num_done}/{num_total} files")
+        return False
+
+    def finish_export(self, result, error_msg):
+        self.render_thread = None
+        self.set_rendering(False)
+
+        if error_msg is not None:
+            self.render_progress.set_text("Export failed")
+            self.show_msg(error_msg, message_type=Gtk.MessageType.ERROR)
+        elif result is None:
+            self.render_progress.set_fraction(0)
+            self.render_progress.set_text("Export stopped")
+        else:
+            self.render_progress.set_fraction(1)
+            self.render_progress.set_text(f"Exported {len(result.files)} files in {result.seconds:.1f}s")
+            instrumentation.log_summary()
+            if not result.files:
+                self.show_msg("There are no rendered pages to export yet", message_type=Gtk.MessageType.WARNING)
+            else:
+                self.show_msg(f"Export finished!\n\nYour pages are in {result.merged_path or os.path.dirname(result.files[0])}")
+
+        return False
+
+    def stop_render(self):
+        if self.render_thread is not None:
+            self.render_cancel_event.set()
+            self.render_stop_button.set_sensitive(False)
+            self.render_progress.set_text("Stopping render")
+
+    def set_rendering(self, rendering):
+        self.render_button.set_sensitive(not rendering)
+        self.export_button.set_sensitive(not rendering)
+        self.render_stop_button.set_sensitive(rendering)
 
     def select_template(self):
         dialog = Gtk.FileChooserDialog(
@@ -157,59 +418,89 @@ class FourPrintars(inkex.GenerateExtension):
             Gtk.STOCK_OPEN, Gtk.ResponseType.OK,
         )
 
-        if default_template_dir := self.get_config('default_template_dir'):
+        if default_template_dir := self.config.get('default_template_dir'):
             dialog.set_current_folder(default_template_dir)
 
+        self.start_preload()
         response = dialog.run()
         if response != Gtk.ResponseType.OK:
             Gtk.main_quit()
 
         self.template_path = dialog.get_filename()
-        self.update_config('default_template_dir', os.path.dirname(self.template_path))
+        self.config.set('default_template_dir', os.path.dirname(self.template_path))
+        self.config.set('default_template_file', self.template_path)
         dialog.destroy()
-        self.load_template()
-        self.load_render_options()
-
-    def get_config(self, *args):
-        if len(args) < 1:
-            raise RuntimeError("Attempted to get config without a valid path!")
-        prefix_keys = args[:-1]
-        final_key = args[-1]
-
-        curr_config_dict = self.config
-        for key in prefix_keys:
-            if key not in curr_config_dict:
-                curr_config_dict = {}
-                break
-            else:
-                curr_config_dict = curr_config_dict[key]
-
-        return curr_config_dict.get(final_key)
-
-    def update_config(self, *args):
-        if len(args) < 2:
-            raise RuntimeError("Attempted to update config without a valid path!")
-        prefix_keys = args[:-2]
-        final_key = args[-2]
-        value = args[-1]
+        loaded = self.load_template()
+        # Covers the template and any tables picked while loading it
+        self.config.flush()
+        return loaded
+
+    def start_preload(self):
+        """Starts loading the last template used, and the tables last used with
+        it, on a background thread while the user is still picking, so that
+        picking the same ones again is quick"""
+        template_path = self.config.get('default_template_file')
+        if not template_path or not os.path.exists(template_path):
+            return
+        table_files = dict(self.config.get('default_table_file') or {})
 
-        curr_config_dict = self.config
-        for key in prefix_keys:
-            if key not in curr_config_dict:
-                curr_config_dict[key] = {}
-            curr_config_dict = curr_config_dict[key]
+        self.preload_path = template_path
+        self.preload_thread = threading.Thread(target=self.preload_in_background,
+                args=(template_path, table_files), daemon=True)
+        self.preload_thread.start()
 
-        if curr_config_dict.get(final_key) != value:
-            curr_config_dict[final_key] = value
-            self.save_config()
+    def preload_in_background(self, template_path, table_files):
+        try:
+            try:
+                template = self.template_registry.load(template_path)
+            finally:
+                self.preload_template_ready.set()
+
+            for table_name, _, _ in template.fields:
+                table_path = table_files.get(table_name)
+                if not table_name or not table_path or (table_name, table_path) in self.preloaded_tables:
+                    continue
+                mtime = os.path.getmtime(table_path)
+                self.preloaded_tables[(table_name, table_path)] = (mtime, Table.from_csv(table_name, table_path))
+        except Exception as e:
+            # Whatever went wrong comes up again, and is reported properly,
+            # if the same file is picked and loaded for real
+            self._log.debug(f"Stopped preloading {template_path}: {e}")
+
+    def preloaded_table(self, table_name, table_path):
+        """The table preloaded from table_path, if there is one and the file
+        hasn't changed since"""
+        if self.preload_thread is None or self.preload_path != self.template_path:
+            return None
+        if (table_name, table_path) not in self.preloaded_tables:
+            self.preload_thread.join()
+        if (table_name, table_path) not in self.preloaded_tables:
+            return None
+
+        mtime, table = self.preloaded_tables.pop((table_name, table_path))
+        if os.path.getmtime(table_path) != mtime:
+            return None
+        return table
 
     def load_template(self):
-        with open(self.template_path, 'r') as f:
-            self.template = inkex.elements.load_svg(f)
-
-        template_tags = self.template.findall("//*[@data-fp-value]")
-        for tag in template_tags:
-            table_name, model_path = tag.attrib['data-fp-value'].split('/', 1)
+        """Loads the chosen template and its tables. Returns False if they
+        can't be used, once the user has been told why"""
+        from lib.template import TemplateError
+
+        if self.preload_thread is not None and self.preload_path == self.template_path:
+            # Finish the preload rather than compiling the same template twice
+            self.preload_template_ready.wait()
+
+        with instrumentation.phase('template_load'):
+            try:
+                self.template = self.template_registry.load(self.template_path)
+            except TemplateError as e:
+                msg = "Failed to load the template. Here's why:\n" + "\n".join(e.errors)
+                self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+                Gtk.main_quit()
+                return False
+
+        for table_name, model_path, display_type in self.template.fields:
             self._log.debug(f"Found template tag for {table_name}/{model_path}")
             if table_name not in self.tables:
                 if not table_name:
@@ -217,10 +508,18 @@ class FourPrintars(inkex.GenerateExtension):
                 else:
                     self.tables[table_name] = self.select_table(table_name)
 
-            self.tables[table_name].add_output_field(model_path, tag.attrib['data-fp-type'])
+            self.tables[table_name].add_output_field(model_path, display_type)
+
+        if errors := check_fields(self.template, self.tables):
+            # The entry form can't be built for fields the tables don't have
+            msg = "The template doesn't match its tables. Here's why:\n" + "\n".join(errors)
+            self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+            Gtk.main_quit()
+            return False
 
         self._log.debug(f"Output fields: {','.join(of.path for of in self.tables[table_name].output_fields)}")
         self._log.info(f"Loaded template: {self.template_path}")
+        return True
 
     def init_add_entry_form(self):
         main_grid = self.builder.get_object('add_entry_main_grid')
@@ -250,10 +549,14 @@ class FourPrintars(inkex.GenerateExtension):
                 entry = Gtk.SearchEntry()
                 entry.set_icon_from_icon_name(Gtk.EntryIconPosition.PRIMARY, 'system-search-symbolic')
                 completion = Gtk.EntryCompletion()
-                completion.set_model(table.data)
+                completion_model = Gtk.ListStore(*([str] * len(table.headers)), int)
+                key_handler = KeyCompletionHandler(table, output_field.path, completion_model)
+                completion.set_model(completion_model)
+                completion.set_match_func(key_handler.match_all)
                 completion.set_text_column(table.header_map[output_field.path])
                 completion.set_inline_completion(True)
                 entry.set_completion(completion)
+                entry.connect('changed', key_handler.on_changed)
             elif output_field.display_type == "displayonly":
                 entry = Gtk.Entry()
                 entry.set_editable(False)
@@ -283,6 +586,7 @@ class FourPrintars(inkex.GenerateExtension):
             entries.append(entry)
 
         handler = EntryTableHandler(entries)
+        self.entry_table_handlers[table.name] = handler
         for entry in entries:
             if entry.get_completion():
                 if not table.header_map:
@@ -299,26 +603,85 @@ class FourPrintars(inkex.GenerateExtension):
             self.show_msg(f"Could not parse \"{qty_text}\" as a quantity. Please input a whole number", message_type=Gtk.MessageType.ERROR)
             return
 
-        record = {}
-
-        record['Quantity'] = qty_text
+        rows = {}
+        overrides = {}
         for table_name, output_dict in self.data_entries['generated'].items():
+            table = self.tables[table_name]
+            row_idx = None
+            if table_name in self.entry_table_handlers:
+                row_idx = self.entry_table_handlers[table_name].selected_row_idx
+            if row_idx is not None:
+                rows[table_name] = row_idx
+
             for output_field_name, entry in output_dict.items():
-                record[table_name + '/' + output_field_name] = self.data_entries['generated'][table_name][output_field_name].get_text()
+                text = entry.get_text()
+                # Only keep what differs from the matched table row, so the
+                # record reads everything else straight from the table
+                if row_idx is None or table.column(output_field_name)[row_idx] != text:
+                    overrides[table_name + '/' + output_field_name] = text
 
-        list_store_record = [None for _ in self.record_index_map]
-        for field_name, field_idx in self.record_index_map.items():
-            list_store_record[field_idx] = record[field_name]
+        self.inventory_model.add(q, rows, overrides)
 
-        self.records.append(list_store_record)
+    def import_orders(self):
+        dialog = Gtk.FileChooserDialog(
+            title="Please choose a CSV or YAML file of orders to import",
+            action=Gtk.FileChooserAction.OPEN
+        )
+        dialog.add_buttons(
+            Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+            Gtk.STOCK_OPEN, Gtk.ResponseType.OK,
+        )
+
+        if default_orders_dir := self.config.get('default_orders_dir'):
+            dialog.set_current_folder(default_orders_dir)
+
+        response = dialog.run()
+        filename = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.OK:
+            return
+        self.config.set('default_orders_dir', os.path.dirname(filename))
+        self.config.flush()
+
+        started = time.monotonic()
+        try:
+            orders = load_inventory(filename)
+            entries, unmatched = RecordResolver(self.tables).join(orders)
+        except InventoryError as e:
+            msg = "Failed to import orders. Here's why:\n" + "\n".join(e.errors)
+            self.show_msg(msg, message_type=Gtk.MessageType.ERROR)
+            return
+        except (OSError, ValueError) as e:
+            self.show_msg(f"Failed to import orders: {e}", message_type=Gtk.MessageType.ERROR)
+            return
+
+        # Telling the view about every new row one at a time takes far longer
+        # than the import itself, so it's detached while they're added and
+        # reads everything afresh when it's given the model back
+        inventory_view = self.builder.get_object('inventory_view')
+        inventory_view.set_model(None)
+        self.records.add_many(entries)
+        inventory_view.set_model(self.inventory_model)
+
+        self._log.info(f"Imported {len(entries)} of {len(orders)} orders from {filename} in {time.monotonic() - started:.2f}s")
+        if unmatched:
+            lines = [f"{table_name}/{path} \"{value}\" ({count} orders)"
+                    for (table_name, path, value), count in unmatched.items()]
+            for line in lines:
+                self._log.info(f"Unmatched key: {line}")
+            shown = "\n".join(lines[:UNMATCHED_KEYS_SHOWN])
+            msg = (f"{len(orders) - len(entries)} orders weren't imported, because these keys "
+                   f"don't match anything in the tables:\n{shown}")
+            if len(lines) > UNMATCHED_KEYS_SHOWN:
+                msg += f"\n...and {len(lines) - UNMATCHED_KEYS_SHOWN} more, listed in the status panel"
+            self.show_msg(msg, message_type=Gtk.MessageType.WARNING)
 
     def remove_current_record(self):
         inventory_view = self.builder.get_object("inventory_view")
         row_path, column = inventory_view.get_cursor()
 
-        iter_ = self.records.get_iter(row_path)
-        if iter_:
-            self.records.remove(iter_)
+        if row_path is not None:
+            self.inventory_model.remove(row_path)
 
     def select_table(self, table_name):
         dialog = Gtk.FileChooserDialog(
@@ -331,7 +694,7 @@ class FourPrintars(inkex.GenerateExtension):
         )
         dialog.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
 
-        if default_table_file := self.get_config('default_table_file', table_name):
+        if default_table_file := self.config.get('default_table_file', table_name):
             dialog.set_filename(default_table_file)
 
         response = dialog.run()
@@ -339,28 +702,42 @@ class FourPrintars(inkex.GenerateExtension):
             Gtk.main_quit()
 
         filename = dialog.get_filename()
-        ret = Table.from_csv(table_name, filename)
-        self.update_config('default_table_file', table_name, filename)
+        with instrumentation.phase('table_load') as p:
+            ret = self.preloaded_table(table_name, filename) or Table.from_csv(table_name, filename)
+            p.add(rows=ret.num_rows)
+        self.config.set('default_table_file', table_name, filename)
 
         dialog.destroy()
 
         self._log.info(f"Loaded {table_name} table from: {filename}")
         return ret
 
-    def run_workflow(self):
+    def run(self):
+        # The template and its tables are picked before inkex is imported or
+        # the document loaded, so the first dialog comes up as soon as
+        # possible - the preload thread makes a start on inkex meanwhile
+        template_picked = self.select_template()
+        from lib.extension import DocumentExtension
+        DocumentExtension(self.run_main_window if template_picked else None).run()
+
+    def run_main_window(self, svg):
+        self.svg = svg
+        self.init_gtk()
+        self.load_render_options()
         self.inventory_window.show_all()
-        self.select_template()
         self.init_add_entry_form()
         self.init_record_table()
-        Gtk.main()
+        try:
+            Gtk.main()
+        finally:
+            self.config.flush()
 
     def init_record_table(self):
-        num_fields = sum(len(table.output_fields) for table in self.tables.values())
-        self.records = Gtk.ListStore(str, *[str] * num_fields)
-        self.record_index_map = {"Quantity": 0}
+        self.records = InventoryStore(self.tables)
+        self.inventory_model = InventoryTreeModel(self.records)
 
         inventory_view = self.builder.get_object('inventory_view')
-        inventory_view.set_model(self.records)
+        inventory_view.set_model(self.inventory_model)
 
         cellrenderertext = Gtk.CellRendererText()
         inventory_view_column = Gtk.TreeViewColumn("Quantity")
@@ -372,7 +749,6 @@ class FourPrintars(inkex.GenerateExtension):
         for table_name, table in self.tables.items():
             for output_field in table.output_fields:
                 full_path = table_name + '/' + output_field.path
-                self.record_index_map[full_path] = ii
 
                 cellrenderertext = Gtk.CellRendererText()
                 inventory_view_column = Gtk.TreeViewColumn(full_path)
@@ -387,9 +763,6 @@ class FourPrintars(inkex.GenerateExtension):
                 inventory_view_column.add_attribute(cellrenderertext, "text", ii)
                 ii += 1
 
-    def effect(self):
-        self.run_workflow()
-
 
 if __name__ == '__main__':
     FourPrintars().run()
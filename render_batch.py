@@ -0,0 +1,266 @@
+"""Renders a whole inventory onto pages without any of the GTK interface.
+
+Example:
+    python render_batch.py examples/item_template.svg \
+        --table Item=examples/items.csv --table Player=examples/players.csv \
+        --inventory order.csv --rows 5 --columns 1 --bleed 2 --output out.svg
+
+Several templates can be rendered in one go, in which case each inventory
+record says which one it's for in a Template field.
+"""
+from lib import instrumentation
+from lib.export import CONVERTERS, DEFAULT_DPI, FORMATS, ExportError, PageExporter
+from lib.inventory import (load_inventory, iter_inventory, resolve_records,
+        inventory_columns, split_quantities, split_by_template, iter_template_records,
+        RecordResolver, InventoryError, TEMPLATE_FIELD)
+from lib.renderer import PackedRenderer, Renderer, RendererError
+from lib.table import Table
+from lib.template import TemplateError
+from lib.template_registry import TemplateRegistry
+from lib.validation import ValidationError, validate
+
+import argparse
+import logging
+import multiprocessing
+import os.path
+import sys
+
+import inkex
+from inkex.base import SvgOutputMixin
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Render Four Printars lammies headlessly")
+    parser.add_argument('templates', nargs='+', metavar='template',
+            help="SVG template file. Give several to render a mixed inventory")
+    parser.add_argument('--table', action='append', default=[], metavar='NAME=CSV',
+            help="CSV file to load a template table from. Repeat for each table")
+    parser.add_argument('--inventory', required=True,
+            help="CSV or YAML file of records to render, each with a Quantity, "
+                 "and with a Template naming the template file if there's more than one")
+    parser.add_argument('--template-cache', metavar='DIR',
+            help="Keep compiled templates in DIR, to skip compiling them next time")
+    parser.add_argument('--rows', default='1')
+    parser.add_argument('--columns', default='1')
+    parser.add_argument('--bleed', default='3', help="Bleed in mm")
+    parser.add_argument('--document',
+            help="SVG document to add pages to. Defaults to an empty A4 document")
+    parser.add_argument('--shared-defs', action='store_true',
+            help="Store the template's static artwork once and reuse it for every copy")
+    parser.add_argument('--compact', action='store_true',
+            help="Give each copy predictable ids, share the template's gradients, filters and "
+                 "stylesheets between copies, and leave out what only Inkscape's editor uses")
+    parser.add_argument('--processes', type=int, default=1,
+            help="Render pages across this many worker processes")
+    parser.add_argument('--pack', action='store_true',
+            help="Pack lammies of every template onto shared pages as tightly as they fit, "
+                 "instead of giving each template its own rows x columns grid")
+    parser.add_argument('--pages-per-file', type=int,
+            help="Stream the output into numbered files of this many pages each, "
+                 "reading the inventory as it goes so memory use stays flat")
+    parser.add_argument('--update', action='store_true',
+            help="Render over the pages an earlier render left in --document, only rebuilding "
+                 "the ones whose lammies have changed")
+    parser.add_argument('--export', metavar='DIR',
+            help="Also export every page into DIR, and merge the PDFs into one ready to print")
+    parser.add_argument('--export-format', nargs='+', choices=FORMATS, default=['pdf'],
+            help="File types to export each page as")
+    parser.add_argument('--export-dpi', type=int, default=DEFAULT_DPI,
+            help="Resolution of exported PNGs")
+    parser.add_argument('--export-workers', type=int,
+            help="Export this many pages at once. Defaults to one per core")
+    parser.add_argument('--converter', choices=CONVERTERS, default='auto',
+            help="What to export pages with. auto uses Inkscape if it can find it, else cairosvg")
+    parser.add_argument('--instrument', action='store_true',
+            help="Log how long each phase of the render took")
+    parser.add_argument('--trace-memory', action='store_true',
+            help="With --instrument, also log each phase's peak memory use")
+    parser.add_argument('--output', required=True, help="Where to write the rendered SVG")
+    parser.add_argument('--verbose', '-v', action='store_true')
+    args = parser.parse_args(argv)
+    if args.pack and args.pages_per_file:
+        parser.error("--pack needs the whole inventory at once, so can't be used with --pages-per-file")
+    if args.export and args.pages_per_file:
+        parser.error("--export works on a single output document, so can't be used with --pages-per-file")
+    if args.processes > 1 and args.pages_per_file:
+        parser.error("--pages-per-file renders one file at a time in a single process, so can't be used with --processes")
+    if args.update and (args.pack or args.pages_per_file):
+        parser.error("--update only works on pages laid out in a grid in --document, so can't be used with --pack or --pages-per-file")
+    return args
+
+
+def load_tables(template, table_args, loaded=None):
+    """Loads the tables a compiled template needs. Tables already in loaded
+    are shared rather than read again, and newly read ones are added to it"""
+    if loaded is None:
+        loaded = {}
+    table_paths = {}
+    for table_arg in table_args:
+        name, sep, path = table_arg.partition('=')
+        if not sep:
+            raise ValueError(f"Could not parse \"{table_arg}\" as NAME=CSV")
+        table_paths[name] = path
+
+    tables = {}
+    for table_name, model_path, display_type in template.fields:
+        if table_name not in tables:
+            if not table_name:
+                tables[table_name] = Table.from_nothing(table_name)
+            elif table_name in loaded:
+                tables[table_name] = loaded[table_name].shared_copy()
+            elif table_name in table_paths:
+                with instrumentation.phase('table_load') as p:
+                    loaded[table_name] = Table.from_csv(table_name, table_paths[table_name])
+                    p.add(rows=loaded[table_name].num_rows)
+                tables[table_name] = loaded[table_name].shared_copy()
+            else:
+                raise ValueError(f"The template needs a {table_name} table. Please pass --table {table_name}=<file>")
+        tables[table_name].add_output_field(model_path, display_type)
+
+    return tables
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    log = logging.getLogger("FourPrintars")
+    log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    logging.basicConfig(stream=sys.stderr)
+
+    if args.instrument:
+        instrumentation.enable(trace_memory=args.trace_memory)
+
+    registry = TemplateRegistry(args.template_cache)
+    templates = {}
+    template_names = {}
+    try:
+        for template_path in args.templates:
+            name = os.path.splitext(os.path.basename(template_path))[0]
+            with instrumentation.phase('template_load'):
+                templates[name] = registry.load(template_path)
+            # Records can name their template with or without the extension
+            template_names[name] = name
+            template_names[os.path.basename(template_path)] = name
+    except TemplateError as e:
+        log.error("Failed to load a template. Here's why:\n" + "\n".join(e.errors))
+        return 1
+    except OSError as e:
+        log.error(str(e))
+        return 1
+    default_template = name if len(templates) == 1 else None
+
+    if args.document:
+        with open(args.document, 'r') as f:
+            svg = inkex.elements.load_svg(f).getroot()
+    else:
+        svg = SvgOutputMixin.get_template(width=210, height=297, unit='mm').getroot()
+
+    render_options = {
+        'rows': args.rows,
+        'columns': args.columns,
+        'bleed': args.bleed,
+    }
+
+    try:
+        loaded_tables = {}
+        tables = {name: load_tables(template, args.table, loaded_tables)
+                for name, template in templates.items()}
+
+        # Everything that would otherwise only go wrong part way through
+        # rendering is checked before any of it starts
+        # An empty inventory has no columns, but then nothing needs them
+        columns = inventory_columns(args.inventory) or None
+        errors = []
+        if columns and default_template is None and TEMPLATE_FIELD not in columns:
+            errors.append(f"The inventory has no {TEMPLATE_FIELD} column to say which template each record is for")
+        for name, template in templates.items():
+            try:
+                validate(template, tables[name], svg, render_options, columns, packed=args.pack)
+            except ValidationError as e:
+                errors += e.errors if len(templates) == 1 else [f"{name}: {error}" for error in e.errors]
+        if errors:
+            raise ValidationError("Invalid render", errors=errors)
+
+        renderers = {name: Renderer(template, svg, render_options, shared_defs=args.shared_defs,
+                        processes=args.processes, incremental=args.update,
+                        compact=args.compact, template_name=name)
+                for name, template in templates.items()}
+
+        if args.pages_per_file:
+            output_stem, output_ext = os.path.splitext(args.output)
+            for name, renderer in renderers.items():
+                records = iter_template_records(iter_inventory(args.inventory), template_names,
+                        name, default_template)
+                records = RecordResolver(tables[name]).iter_resolved(records)
+                output_path = args.output if len(renderers) == 1 else f"{output_stem}-{name}{output_ext}"
+                renderer.render_to_files(split_quantities(records), output_path, args.pages_per_file)
+            instrumentation.log_summary()
+            return 0
+
+        grouped = split_by_template(load_inventory(args.inventory), template_names, default_template)
+        entries = {}
+        errors = []
+        for name, records in grouped.items():
+            try:
+                entries[name] = list(split_quantities(resolve_records(records, tables[name])))
+            except InventoryError as e:
+                errors += e.errors
+        if errors:
+            raise InventoryError("Could not resolve inventory", errors=errors)
+
+        if args.pack:
+            if args.processes > 1:
+                log.info("Packed pages are rendered in a single process")
+            packed_renderer = PackedRenderer(renderers, svg)
+            packed_renderer.add_to_document(packed_renderer.build(entries))
+        else:
+            # Each template gets pages of its own, numbered on from the last
+            first_page_idx = 0
+            page_ranges = {}
+            for name, renderer in renderers.items():
+                page_ranges[name] = (first_page_idx, first_page_idx)
+                if not entries[name]:
+                    continue
+                result = renderer.build(entries[name], first_page_idx=first_page_idx)
+                renderer.add_to_document(result)
+                first_page_idx += result.num_pages
+                page_ranges[name] = (result.first_page_idx, first_page_idx)
+            if args.update:
+                # Each template's pages may be numbered differently from last
+                # time, so whatever it left outside its new ones goes
+                for name, renderer in renderers.items():
+                    renderer.remove_pages_outside(*page_ranges[name])
+    except (RendererError, InventoryError, ValidationError) as e:
+        log.error("Failed to render. Here's why:\n" + "\n".join(e.errors))
+        return 1
+    except (ValueError, OSError) as e:
+        log.error(str(e))
+        return 1
+
+    with instrumentation.phase('serialization'):
+        with open(args.output, 'wb') as f:
+            f.write(svg.tostring())
+    log.info(f"Wrote {args.output}")
+
+    if args.export:
+        output_stem = os.path.splitext(os.path.basename(args.output))[0]
+        try:
+            exporter = PageExporter(svg, args.export, args.export_format, args.converter,
+                    args.export_workers, args.export_dpi)
+            result = exporter.export(merged_path=os.path.join(args.export, f"{output_stem}.pdf"))
+        except ExportError as e:
+            log.error("Failed to export. Here's why:\n" + "\n".join(e.errors))
+            return 1
+        except OSError as e:
+            log.error(str(e))
+            return 1
+        if result.merged_path:
+            log.info(f"Wrote {result.merged_path}")
+
+    instrumentation.log_summary()
+    return 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())